@@ -2,6 +2,21 @@
 # coding: utf-8
 
 from lib.labeler.annotation import BoundingBox
+from lib.labeler.annotation import BoxSet
+from lib.labeler.annotation import BoxView
 from lib.labeler.annotation import Line
+from lib.labeler.annotation import LineArray
+from lib.labeler.annotation import PointSet
+from lib.labeler.annotation import box_iou_matrix
+from lib.labeler.annotation import box_nms
+from lib.labeler.annotation import find_duplicate_boxes
 from lib.labeler.labeler import Labeler
 from lib.labeler.labeler import ScaleLabeler
+from lib.labeler.prefetch import SamplePrefetcher
+from lib.labeler.profiler import FrameProfiler
+from lib.labeler.spatial import GridIndex
+from lib.labeler.storage import AnnotationStore
+from lib.labeler.storage import JsonFileStore
+from lib.labeler.storage import SqliteStore
+from lib.labeler.storage import convert_annotations
+from lib.labeler.storage import create_annotation_store
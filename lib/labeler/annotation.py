@@ -2,9 +2,12 @@
 # coding: utf-8
 
 import math
+import numpy as np
 
 
 class BoundingBox:
+    __slots__ = ("x1", "y1", "x2", "y2")
+
     def __init__(self, x1=-1, y1=-1, x2=-1, y2=-1):
         self.x1, self.y1, self.x2, self.y2 = x1, y1, x2, y2
 
@@ -28,7 +31,8 @@ class BoundingBox:
 
     def contains(self, *, point=None, bbox=None):
         if point is not None:
-            bbox = BoundingBox(*point, *point)
+            x1, y1, x2, y2 = self.bbox
+            return x1 <= point[0] <= x2 and y1 <= point[1] <= y2
         if isinstance(bbox, (tuple, list)):
             bbox = BoundingBox(*bbox)
         a1, b1, a2, b2 = bbox.bbox
@@ -48,6 +52,7 @@ class BoundingBox:
 
     def iou(self, other):
         intersect = self.intersect(other)
+        if not intersect.valid(): return 0.0
         return intersect.area / (self.area + other.area - intersect.area)
 
     @property
@@ -60,8 +65,9 @@ class BoundingBox:
 
     @property
     def bbox(self):
-        x1, y1 = self.top_left
-        x2, y2 = self.bottom_right
+        x1, y1, x2, y2 = self.x1, self.y1, self.x2, self.y2
+        if x1 > x2: x1, x2 = x2, x1
+        if y1 > y2: y1, y2 = y2, y1
         return x1, y1, x2, y2
 
     @property
@@ -90,6 +96,352 @@ class BoundingBox:
         return f"bbox: [x1 = {x1}, y1 = {y1}, x2 = {x2}, y2 = {y2}]"
 
 
+class BoxView(BoundingBox):
+    """BoxSet中一个矩形的视图, 读写坐标时直接访问BoxSet中的数组.
+
+    同一个矩形的不同视图是相等的, 可以作为dict的key.
+    """
+
+    __slots__ = ("owner", "box_id", "row")
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, owner, box_id, row=0):
+        self.owner = owner
+        self.box_id = box_id
+        self.row = row
+
+    def _row(self):
+        # 删除其他矩形之后行号可能会变化, 这时需要重新查找
+        ids = self.owner.ids
+        if self.row >= len(ids) or ids[self.row] != self.box_id:
+            self.row = self.owner.row(self.box_id)
+        return self.row
+
+    def _get(self, column):
+        return self.owner.boxes[self._row(), column].item()
+
+    def _set(self, column, value):
+        self.owner.set_value(self._row(), column, value)
+
+    x1 = property(lambda self: self._get(0), lambda self, v: self._set(0, v))
+    y1 = property(lambda self: self._get(1), lambda self, v: self._set(1, v))
+    x2 = property(lambda self: self._get(2), lambda self, v: self._set(2, v))
+    y2 = property(lambda self: self._get(3), lambda self, v: self._set(3, v))
+
+    @property
+    def bbox(self):
+        x1, y1, x2, y2 = self.owner.boxes[self._row()].tolist()
+        if x1 > x2: x1, x2 = x2, x1
+        if y1 > y2: y1, y2 = y2, y1
+        return x1, y1, x2, y2
+
+    def __eq__(self, other):
+        return (isinstance(other, BoxView) and other.owner is self.owner and
+                other.box_id == self.box_id)
+
+    def __hash__(self):
+        return hash((id(self.owner), self.box_id))
+
+
+def _as_coords(values, columns):
+    """将坐标转换为N x columns的数组.
+
+    整数坐标保存为int64, 有浮点数时(比如外部或者转换来的json标注)保存为
+    float64, 与BoundingBox一样不会截断.
+    """
+
+    values = np.asarray(values)
+    # 空的列表也是float64, 这时用int64
+    is_float = values.dtype.kind == "f" and values.size > 0
+    dtype = np.float64 if is_float else np.int64
+    return values.astype(dtype).reshape(-1, columns)
+
+
+class BoxSet:
+    """用N x 4的numpy数组保存的矩形集合, 每一行为(x1, y1, x2, y2).
+
+    坐标的约定与BoundingBox相同: 包括边界, 宽高都要加1. 每个矩形有一个唯一
+    的id, 删除其他矩形之后也不会变化. boxes[i]返回第i个矩形的BoxView,
+    所有的几何运算都是对整个数组进行的. 整数坐标保存为int64, 浮点数坐标
+    保存为float64, 只有increase/decrease与BoundingBox一样会四舍五入为整数.
+
+    Args:
+        boxes: 矩形列表, 每一项可以是BoundingBox或者(x1, y1, x2, y2).
+    """
+
+    def __init__(self, boxes=()):
+        boxes = [b.bbox if isinstance(b, BoundingBox) else b for b in boxes]
+        self.boxes = _as_coords(boxes, 4)
+        # ids总是递增的, 所以可以用二分查找由id得到行号
+        self.ids = np.arange(len(self.boxes), dtype=np.int64)
+        self.next_id = len(self.boxes)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, row):
+        return BoxView(self, int(self.ids[row]), row % len(self))
+
+    def __iter__(self):
+        for row, box_id in enumerate(self.ids.tolist()):
+            yield BoxView(self, box_id, row)
+
+    def row(self, box_id):
+        row = int(np.searchsorted(self.ids, box_id))
+        if row >= len(self.ids) or self.ids[row] != box_id:
+            raise KeyError(f"Unknown box id: {box_id}")
+        return row
+
+    def get(self, box_id):
+        return BoxView(self, box_id, self.row(box_id))
+
+    def set_value(self, row, column, value):
+        # 整数数组中写入浮点数时转为float64, 以免被截断
+        if isinstance(value, float) and self.boxes.dtype.kind != "f":
+            self.boxes = self.boxes.astype(np.float64)
+        self.boxes[row, column] = value
+
+    def append(self, bbox):
+        """添加一个矩形, 返回其BoxView."""
+
+        if isinstance(bbox, BoundingBox):
+            bbox = (bbox.x1, bbox.y1, bbox.x2, bbox.y2)
+        self.boxes = np.concatenate([self.boxes, _as_coords(bbox, 4)])
+        self.ids = np.append(self.ids, self.next_id)
+        self.next_id += 1
+        return BoxView(self, self.next_id - 1, len(self.boxes) - 1)
+
+    def remove(self, bbox):
+        """删除一个矩形, bbox为BoxView或者id."""
+
+        box_id = bbox.box_id if isinstance(bbox, BoxView) else bbox
+        row = self.row(box_id)
+        self.boxes = np.delete(self.boxes, row, axis=0)
+        self.ids = np.delete(self.ids, row)
+
+    def to_list(self):
+        """返回[[x1, y1, x2, y2], ...], 保存为json时使用."""
+
+        return self.bbox.tolist()
+
+    @property
+    def bbox(self):
+        x1 = np.minimum(self.boxes[:, 0], self.boxes[:, 2])
+        y1 = np.minimum(self.boxes[:, 1], self.boxes[:, 3])
+        x2 = np.maximum(self.boxes[:, 0], self.boxes[:, 2])
+        y2 = np.maximum(self.boxes[:, 1], self.boxes[:, 3])
+        return np.stack([x1, y1, x2, y2], axis=1)
+
+    @property
+    def width(self):
+        return np.abs(self.boxes[:, 0] - self.boxes[:, 2]) + 1
+
+    @property
+    def height(self):
+        return np.abs(self.boxes[:, 1] - self.boxes[:, 3]) + 1
+
+    @property
+    def area(self):
+        return self.width * self.height
+
+    def valid(self):
+        return self.boxes.min(axis=1) >= 0
+
+    def increase(self, scale):
+        self.boxes = np.round(self.boxes * scale).astype(np.int64)
+
+    def decrease(self, scale):
+        self.increase(1.0 / scale)
+
+    def translate(self, offset_x, offset_y):
+        # 偏移为浮点数时结果也是浮点数, 与BoundingBox一致
+        self.boxes = self.boxes + np.array(
+            [offset_x, offset_y, offset_x, offset_y])
+
+    def contains(self, *, point=None, bbox=None):
+        """返回每一个矩形是否包含point或者bbox, 结果为长度为N的bool数组."""
+
+        if point is not None:
+            bbox = (point[0], point[1], point[0], point[1])
+        if isinstance(bbox, BoundingBox): bbox = bbox.bbox
+        a1, b1, a2, b2 = bbox
+        a1, a2 = min(a1, a2), max(a1, a2)
+        b1, b2 = min(b1, b2), max(b1, b2)
+        boxes = self.bbox
+        return ((boxes[:, 0] <= a1) & (boxes[:, 1] <= b1) &
+                (boxes[:, 2] >= a2) & (boxes[:, 3] >= b2))
+
+    def intersect(self, other):
+        """返回每一个矩形与other(BoundingBox)的交集, 没有交集的为-1."""
+
+        boxes = self.bbox
+        ox1, oy1, ox2, oy2 = other.bbox
+        x1 = np.maximum(boxes[:, 0], ox1)
+        y1 = np.maximum(boxes[:, 1], oy1)
+        x2 = np.minimum(boxes[:, 2], ox2)
+        y2 = np.minimum(boxes[:, 3], oy2)
+        result = np.stack([x1, y1, x2, y2], axis=1)
+        empty = (result[:, 0] > result[:, 2]) | (result[:, 1] > result[:, 3])
+        result[empty] = -1
+        return result
+
+    def iou(self, other):
+        """返回N x M的iou矩阵, other为BoxSet或者M x 4的数组."""
+
+        return box_iou_matrix(self, other)
+
+
+def _as_boxes(boxes):
+    """将BoxSet, BoundingBox列表或者N x 4的数组统一为(x1, y1, x2, y2)数组."""
+
+    if isinstance(boxes, BoxSet): return boxes.bbox
+    boxes = [b.bbox if isinstance(b, BoundingBox) else b for b in boxes]
+    boxes = _as_coords(boxes, 4)
+    lower = np.minimum(boxes[:, :2], boxes[:, 2:])
+    upper = np.maximum(boxes[:, :2], boxes[:, 2:])
+    return np.concatenate([lower, upper], axis=1)
+
+
+def box_iou_matrix(boxes1, boxes2):
+    """返回N x M的iou矩阵, 宽高的计算与BoundingBox一致(包括边界, 要加1)."""
+
+    boxes1, boxes2 = _as_boxes(boxes1), _as_boxes(boxes2)
+    x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    inter = np.clip(x2 - x1 + 1, 0, None) * np.clip(y2 - y1 + 1, 0, None)
+    area1 = (boxes1[:, 2:] - boxes1[:, :2] + 1).prod(axis=1)
+    area2 = (boxes2[:, 2:] - boxes2[:, :2] + 1).prod(axis=1)
+    return inter / (area1[:, None] + area2[None, :] - inter)
+
+
+def box_nms(boxes, scores=None, threshold=0.5):
+    """贪心的非极大值抑制, 返回保留下来的矩形的下标, 按照score从大到小排列.
+
+    scores为None时, 按照矩形的先后顺序决定优先级.
+    """
+
+    boxes = _as_boxes(boxes)
+    if scores is None:
+        order = np.arange(len(boxes))
+    else:
+        order = np.argsort(-np.asarray(scores), kind="stable")
+    keep = []
+    while len(order) > 0:
+        keep.append(int(order[0]))
+        ious = box_iou_matrix(boxes[order[:1]], boxes[order[1:]])[0]
+        order = order[1:][ious <= threshold]
+    return keep
+
+
+def find_duplicate_boxes(boxes, threshold=0.9, block_size=256):
+    """找出重复的矩形, iou > threshold的两个矩形被认为是重复的.
+
+    重复关系是传递的, 返回所有包含两个及以上矩形的组, 每一组为下标的列表.
+    矩形按照x1排序之后分块计算iou, 每一块只需要与x方向上可能相交的矩形
+    比较, 内存和计算量都不再是N x N.
+    """
+
+    boxes = _as_boxes(boxes)
+    order = np.argsort(boxes[:, 0], kind="stable")
+    boxes = boxes[order]
+    parents = list(range(len(boxes)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for start in range(0, len(boxes), block_size):
+        block = boxes[start:start + block_size]
+        # x1大于本块最大的x2的矩形不可能与本块中的矩形相交
+        end = int(np.searchsorted(boxes[:, 0], block[:, 2].max(), "right"))
+        ious = box_iou_matrix(block, boxes[start:end])
+        rows, cols = np.nonzero(ious > threshold)
+        for i, j in zip(rows.tolist(), cols.tolist()):
+            if i < j: parents[find(start + j)] = find(start + i)
+
+    groups = {}
+    for i in range(len(boxes)):
+        groups.setdefault(find(i), []).append(int(order[i]))
+    groups = [sorted(group) for group in groups.values() if len(group) > 1]
+    return sorted(groups)
+
+
+class PointSet:
+    """用N x 2的numpy数组保存的点集合, 每一行为(x, y).
+
+    遍历时返回(x, y)形式的tuple, 与原来用list保存点时一致. 坐标类型的
+    约定与BoxSet相同.
+
+    Args:
+        points: 点列表, 每一项为(x, y).
+    """
+
+    def __init__(self, points=()):
+        self.points = _as_coords(list(points), 2)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, row):
+        return tuple(self.points[row].tolist())
+
+    def __iter__(self):
+        return iter([tuple(point) for point in self.points.tolist()])
+
+    def __contains__(self, point):
+        return bool(self._match(point).any())
+
+    def _match(self, point):
+        return (self.points[:, 0] == point[0]) & (self.points[:, 1] == point[1])
+
+    def append(self, point):
+        self.points = np.concatenate([self.points, _as_coords(point, 2)])
+
+    def remove(self, point):
+        """删除第一个与point相同的点, 与list.remove一致."""
+
+        rows = np.flatnonzero(self._match(point))
+        if len(rows) == 0:
+            raise ValueError(f"{point} is not in PointSet")
+        self.points = np.delete(self.points, rows[0], axis=0)
+
+    def to_list(self):
+        return self.points.tolist()
+
+    def increase(self, scale):
+        self.points = np.round(self.points * scale).astype(np.int64)
+
+    def decrease(self, scale):
+        self.increase(1.0 / scale)
+
+    def translate(self, offset_x, offset_y):
+        self.points = self.points + np.array([offset_x, offset_y])
+
+    def distances(self, x, y):
+        """返回每一个点到(x, y)的距离的平方."""
+
+        return (self.points[:, 0] - x)**2 + (self.points[:, 1] - y)**2
+
+    def nearest(self, x, y):
+        """返回离(x, y)最近的点及其距离的平方, 没有点时返回(None, None)."""
+
+        if len(self) == 0: return None, None
+        distances = self.distances(x, y)
+        row = int(np.argmin(distances))
+        return self[row], distances[row].item()
+
+    def inside(self, bbox):
+        """返回每一个点是否在bbox(BoundingBox)中."""
+
+        x1, y1, x2, y2 = bbox.bbox
+        xs, ys = self.points[:, 0], self.points[:, 1]
+        return (x1 <= xs) & (xs <= x2) & (y1 <= ys) & (ys <= y2)
+
+
 class Line:
     """直线类, 方程为: ax + by + c = 0."""
 
@@ -145,10 +497,10 @@ class Line:
         return self.get_angle_with_line(other) < self.epsilon
 
     def parallel_to_axis_x(self):
-        return self.parallel_to(Line.create_from_points(0, 0, 1, 0))
+        return self.parallel_to(_AXIS_X)
 
     def parallel_to_axis_y(self):
-        return self.parallel_to(Line.create_from_points(0, 0, 0, 1))
+        return self.parallel_to(_AXIS_Y)
 
     def get_angle_with_line(self, other):
         """返回两直线夹角, 范围为: [0, pi/2]"""
@@ -165,8 +517,7 @@ class Line:
     def get_slant_angle(self):
         """返回倾斜角, 范围为: [0, pi]"""
 
-        axis_x = Line.create_from_points(0, 0, 1, 0)
-        angle = self.get_angle_with_line(axis_x)
+        angle = self.get_angle_with_line(_AXIS_X)
         if self.a * self.b > 0: angle = math.pi - angle
         return angle
 
@@ -196,5 +547,151 @@ class Line:
         return self.get_y(x) < y
 
 
+# 坐标轴只需要创建一次, 不需要在每次判断时重新创建
+_AXIS_X = Line.create_from_points(0, 0, 1, 0)
+_AXIS_Y = Line.create_from_points(0, 0, 0, 1)
+
+
+class LineArray:
+    """N条直线, 方程为: a[i]x + b[i]y + c[i] = 0, 系数保存为N x 3的数组.
+
+    与Line的接口对应, 但是所有的运算都是向量化的. 点的坐标可以是标量或者
+    任意形状的数组, 结果的形状为(N,) + 点的形状. 直线与坐标轴平行时,
+    left_to等判断的结果与Line一致(为False). Line中会抛出ZeroDivisionError
+    的情况(两直线平行时求交点, 退化的直线a = b = 0), 这里返回nan, 退化
+    直线的所有判断都返回False.
+    """
+
+    epsilon = 1.0e-9
+
+    def __init__(self, coefficients=()):
+        lines = np.array(coefficients, dtype=np.float64).reshape(-1, 3)
+        factor = np.maximum(
+            np.abs(lines).max(axis=1, initial=0.0), self.epsilon)
+        self.lines = lines / factor[:, None]
+
+    @staticmethod
+    def create_from_lines(lines):
+        return LineArray([line.to_list() for line in lines])
+
+    @staticmethod
+    def create_from_points(x1, y1, x2, y2):  # 两点式
+        x1, y1, x2, y2 = np.broadcast_arrays(x1, y1, x2, y2)
+        return LineArray(np.stack([y2 - y1, x1 - x2, x2 * y1 - y2 * x1], 1))
+
+    @staticmethod
+    def create_from_pointk(x0, y0, a, b):  # 点斜式, 方向向量表示
+        x0, y0, a, b = np.broadcast_arrays(x0, y0, a, b)
+        return LineArray(np.stack([b, -a, a * y0 - b * x0], 1))
+
+    @staticmethod
+    def create_from_pointa(x0, y0, angle):  # 点斜式, 方向角表示
+        angle = np.asarray(angle, dtype=np.float64)
+        cos, sin = np.cos(angle), np.sin(angle)
+        return LineArray.create_from_pointk(x0, y0, cos, sin)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        return Line(*self.lines[index].tolist())
+
+    def _coefficients(self, value):
+        # 将系数的形状变为(N, 1, ...), 以便与点的坐标进行广播
+        value = np.asarray(value, dtype=np.float64)
+        shape = (len(self),) + (1,) * value.ndim
+        a, b, c = (self.lines[:, i].reshape(shape) for i in range(3))
+        return a, b, c, value
+
+    def get_x(self, y):
+        a, b, c, y = self._coefficients(y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return -(b * y + c) / a
+
+    def get_y(self, x):
+        a, b, c, x = self._coefficients(x)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return -(a * x + c) / b
+
+    def get_cross_points(self, other):
+        """返回与other(Line或者等长的LineArray)的交点, 平行时为nan."""
+
+        a1, b1, c1 = self.lines.T
+        if isinstance(other, Line):
+            a2, b2, c2 = other.a, other.b, other.c
+        else:
+            a2, b2, c2 = other.lines.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = (c2 * b1 - c1 * b2) / (a1 * b2 - a2 * b1)
+            y = (c2 * a1 - c1 * a2) / (a2 * b1 - a1 * b2)
+        parallel = (a1 * b2 - a2 * b1) == 0
+        x[parallel], y[parallel] = np.nan, np.nan
+        return x, y
+
+    def get_angles_with_line(self, other):
+        """返回与other(Line)的夹角, 范围为: [0, pi/2]"""
+
+        a, b = self.lines[:, 0], self.lines[:, 1]
+        numerator = a * other.a + b * other.b
+        self_norm = a * a + b * b
+        other_norm = other.a * other.a + other.b * other.b
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cos_theta = np.abs(numerator / np.sqrt(self_norm * other_norm))
+        return np.arccos(np.minimum(cos_theta, 1.0))
+
+    def get_slant_angles(self):
+        """返回倾斜角, 范围为: [0, pi]"""
+
+        angles = self.get_angles_with_line(_AXIS_X)
+        flip = self.lines[:, 0] * self.lines[:, 1] > 0
+        angles[flip] = np.pi - angles[flip]
+        return angles
+
+    def get_distances(self, x=0, y=0):
+        x, y = np.broadcast_arrays(x, y)
+        a, b, c, x = self._coefficients(x)
+        norm = np.sqrt(a**2 + b**2)
+        norm[norm == 0] = np.nan
+        return np.abs(a * x + b * y + c) / norm
+
+    def degenerate(self):
+        return (self.lines[:, 0] == 0) & (self.lines[:, 1] == 0)
+
+    def parallel_to_axis_x(self):
+        return self.get_angles_with_line(_AXIS_X) < self.epsilon
+
+    def parallel_to_axis_y(self):
+        return self.get_angles_with_line(_AXIS_Y) < self.epsilon
+
+    def _side_test(self, values, excluded):
+        excluded = excluded | self.degenerate()
+        excluded = excluded.reshape((len(self),) + (1,) * (values.ndim - 1))
+        return values & ~excluded
+
+    # 线在点的左边
+    def left_to(self, x, y):
+        with np.errstate(invalid="ignore"):
+            values = self.get_x(y) < np.asarray(x)
+        return self._side_test(values, self.parallel_to_axis_x())
+
+    # 线在点的右边
+    def right_to(self, x, y):
+        with np.errstate(invalid="ignore"):
+            values = self.get_x(y) > np.asarray(x)
+        return self._side_test(values, self.parallel_to_axis_x())
+
+    # 线在点的上边, 注意这里坐标系和图像坐标系不同
+    def above_to(self, x, y):
+        with np.errstate(invalid="ignore"):
+            values = self.get_y(x) > np.asarray(y)
+        return self._side_test(values, self.parallel_to_axis_y())
+
+    # 线在点的下边, 注意这里坐标系和图像坐标系不同
+    def below_to(self, x, y):
+        with np.errstate(invalid="ignore"):
+            values = self.get_y(x) < np.asarray(y)
+        return self._side_test(values, self.parallel_to_axis_y())
+
+
 if __name__ == "__main__":
     pass
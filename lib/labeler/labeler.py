@@ -4,7 +4,9 @@
 import os
 import cv2
 import copy
+import time
 import logging
+import numpy as np
 
 import lib.util
 
@@ -12,36 +14,81 @@ import lib.util
 # 回调函数需要在全局空间中定义, 所以从Labeler中独立出来.
 # 这里只是简单调用Labeler中的方法, 真正的实现还是在Labeler中.
 def _on_mouse_callback(event, x, y, flags, self):
-    self._mouse_callback(event, x, y, flags)
+    with self.profiler.span("mouse"):
+        self._mouse_callback(event, x, y, flags)
 
 
 class Labeler:
     """标注类的基类. 其他标注类可以继承自本类.
 
     本类需要的参数由params传入, params为dict类型, 其中key的含义如下:
-    img_dir:  图像文件目录
-    ann_dir:  标注文件目录
-    samples:  样本列表文件, 每一行代表一个样本. 不能有扩展名.
-    snapshot: 标注进度文件
+    img_dir:           图像文件目录
+    ann_dir:           标注文件目录, ann_backend为sqlite时为数据库文件
+    samples:           样本列表文件, 每一行代表一个样本. 不能有扩展名.
+    snapshot:          标注进度文件
+    prefetch:          可选, (ahead, behind), 在后台预取当前样本之后ahead个
+                       和之前behind个样本. 不设置则不预取.
+    image_cache:       可选, 解码后图像的缓存目录, 不设置则不缓存.
+    image_cache_size:  可选, 图像缓存的最大字节数.
+    async_save:        可选, 为True时在后台线程中保存标注和进度.
+    snapshot_interval: 可选, 保存进度的最小时间间隔(秒), 默认为5秒.
+    snapshot_moves:    可选, 前进/后退多少次之后一定保存进度, 默认为10.
+    ann_backend:       可选, 标注的存储方式, 可以为json(默认, 每个样本一个
+                       json文件)或者sqlite(所有标注保存在一个数据库中).
+    profile_trace:     可选, 每一帧各个阶段的耗时以json lines的格式追加到
+                       这个文件中, 不设置则不输出.
 
     本类定义了以下基本动作:
     [enter] or 'f':      前进一个样本
     [backspace] or 'b':  后退一个样本
     's':                 保存当前标注
+    'p':                 显示/隐藏各个阶段耗时的p50/p95
 
     继承本类时, 需要注意:
     1. self.curr_annotations纪录当前样本的标注信息, 其初始值为: None
+    2. 只有在self.dirty为True时才会重新绘制图像, 所以改变了显示内容的
+       操作需要调用self._invalidate()
+    3. 只有标注被修改过才会保存, 所以修改self.curr_annotations之后需要调用
+       self._modify()
     """
 
     def __init__(self, params):
         self.img_dir = params["img_dir"]
         self.ann_dir = params["ann_dir"]
         self.snapshot_file = params["snapshot"]
-        self.samples = lib.util.read_list_file(params["samples"])
+        self.writer = None
+        if params.get("async_save"):
+            self.writer = lib.util.AsyncJsonWriter()
+        self.ann_store = lib.labeler.create_annotation_store(
+            params.get("ann_backend", "json"), self.ann_dir, self.writer)
+        self.samples = lib.util.SampleList(params["samples"])
         self.samples_id = self._load_snapshot()
+        self.snapshot_interval = params.get("snapshot_interval", 5.0)
+        self.snapshot_moves = params.get("snapshot_moves", 10)
+        self.snapshot_time = time.time()
+        self.snapshot_samples_id = self.samples_id
+        self.num_moves = 0
+        self.image_cache = None
+        if params.get("image_cache"):
+            self.image_cache = lib.util.DecodedImageCache(
+                params["image_cache"], params.get("image_cache_size", 4 << 30))
+        self.prefetcher = None
+        if params.get("prefetch"):
+            ahead, behind = params["prefetch"]
+            self.prefetcher = lib.labeler.SamplePrefetcher(
+                self._load_sample,
+                len(self.samples),
+                ahead=ahead,
+                behind=behind)
+        self.profiler = lib.labeler.FrameProfiler(params.get("profile_trace"))
+        self.show_profile = False
         # 工作中的变量
         self.curr_image = None
         self.curr_annotations = None
+        self.dirty = True
+        # 每次修改标注时curr_revision加1, 保存时纪录到saved_revision
+        self.curr_revision = 0
+        self.saved_revision = 0
 
     def _load_snapshot(self):
         if os.path.exists(self.snapshot_file):
@@ -50,37 +97,68 @@ class Labeler:
                 return content["samples_id"]
         return 0
 
-    def _save_snapshot(self):
-        lib.util.write_json_file({
-            "samples_id": self.samples_id
-        }, self.snapshot_file)
+    def _write_json_file(self, data, path):
+        if self.writer is not None:
+            self.writer.write(data, path)
+        else:
+            lib.util.write_json_file(data, path, atomic=True)
+
+    def _save_snapshot(self, force=False):
+        # 进度没有变化时不保存, 否则至少间隔snapshot_interval秒或者
+        # snapshot_moves次移动才保存一次
+        if not force:
+            if self.samples_id == self.snapshot_samples_id: return
+            elapsed = time.time() - self.snapshot_time
+            if (elapsed < self.snapshot_interval and
+                    self.num_moves < self.snapshot_moves):
+                return
+        self._write_json_file({"samples_id": self.samples_id},
+                              self.snapshot_file)
+        self.snapshot_time = time.time()
+        self.snapshot_samples_id = self.samples_id
+        self.num_moves = 0
 
     def _load_image(self, samples_id):
         name = self.samples[samples_id] + ".jpg"
         path = os.path.join(self.img_dir, name)
-        image = cv2.imread(path, 1)
+        if self.image_cache is not None:
+            image = self.image_cache.imread(path, 1)
+        else:
+            image = cv2.imread(path, 1)
         assert image is not None, f"Failed to load image: {path}"
         return image
 
     def _load_annotations(self, samples_id):
-        name = self.samples[samples_id] + ".json"
-        path = os.path.join(self.ann_dir, name)
-        if not os.path.exists(path): return None
-        return lib.util.read_json_file(path)
+        return self.ann_store.load(self.samples[samples_id])
+
+    def _load_sample(self, samples_id):
+        # 预取时在后台线程中调用, 不能修改self中的任何变量
+        image = self._load_image(samples_id)
+        annotations = self._load_annotations(samples_id)
+        return image, annotations
 
     def _load_curr_sample(self):
-        self.curr_image = self._load_image(self.samples_id)
-        self.curr_annotations = self._load_annotations(self.samples_id)
+        with self.profiler.span("load"):
+            if self.prefetcher is None:
+                sample = self._load_sample(self.samples_id)
+            else:
+                sample = self.prefetcher.get(self.samples_id)
+        self.curr_image, self.curr_annotations = sample
+        self.curr_revision = self.saved_revision = 0
+        self._invalidate()
 
     def _save_annotations(self, annotations, samples_id):
         if not annotations: return
-        name = self.samples[samples_id] + ".json"
-        path = os.path.join(self.ann_dir, name)
-        lib.util.write_json_file(annotations, path)
+        self.ann_store.save(self.samples[samples_id], annotations)
 
-    def _save_curr_sample(self):
-        self._save_annotations(self.curr_annotations, self.samples_id)
-        self._save_snapshot()
+    def _save_curr_sample(self, force=False):
+        with self.profiler.span("save"):
+            # 标注没有被修改过就不需要重新保存
+            if force or self.curr_revision != self.saved_revision:
+                self._save_annotations(self.curr_annotations, self.samples_id)
+                self.saved_revision = self.curr_revision
+            if force: self.ann_store.flush()
+            self._save_snapshot(force)
 
     def _move(self, step):
         samples_id = self.samples_id + step
@@ -89,19 +167,54 @@ class Labeler:
         elif samples_id >= len(self.samples):
             logging.info("We reach the end.")
         else:
-            self._save_curr_sample()
-            self.samples_id = samples_id
-            self._load_curr_sample()
+            with self.profiler.span("move"):
+                modified = self.curr_revision != 0
+                self._save_curr_sample()
+                # 当前样本的标注被修改过, 离开时从预取cache中删除
+                if self.prefetcher is not None and modified:
+                    self.prefetcher.invalidate(self.samples_id)
+                self.samples_id = samples_id
+                self.num_moves += 1
+                self._load_curr_sample()
+
+    def _invalidate(self):
+        # 标记当前显示的图像已经过期, 下一次循环时重新绘制
+        self.dirty = True
+
+    def _modify(self):
+        # 标记当前样本的标注已经被修改
+        self.curr_revision += 1
+        self._invalidate()
 
     def _draw_text_lines(self, image):
         # 这里仅仅写上标注进度, 如需写其他信息可以重载这个函数
         origin, color = (20, 20), (0, 0, 255)
         line = f"Progress: {self.samples_id+1}/{len(self.samples)}"
-        return lib.util.draw_textlines(image, origin, line, color)
+        return lib.util.draw_textlines(image, origin, line, color, inplace=True)
 
     def _draw_curr_image(self):
         # 这里仅仅在图像中显示进度, 需要重载此函数来画标注信息
-        self._draw_text_lines(copy.deepcopy(self.curr_image))
+        image = copy.deepcopy(self.curr_image)
+        with self.profiler.span("text"):
+            return self._draw_text_lines(image)
+
+    # 显示在进度下方的耗时统计
+    profile_spans = ("render",
+                     "draw",
+                     "extract",
+                     "text",
+                     "static",
+                     "imshow",
+                     "mouse",
+                     "key",
+                     "move",
+                     "load",
+                     "save")
+
+    def _draw_profile(self, image):
+        lines = self.profiler.summary_lines(self.profile_spans)
+        return lib.util.draw_textlines(
+            image, (20, 60), lines, (0, 255, 0), size=20, inplace=True)
 
     # 如果需要鼠标响应事件, 请重载这个函数
     def _mouse_callback(self, event, x, y, flags):
@@ -110,6 +223,7 @@ class Labeler:
     def _key_callback(self, key):
         if key == 255 or key == -1: return
         logging.info("Pressed key: %d", key)
+        self._invalidate()
         if key == ord("\r"):
             self._move(1)
         elif key == ord("\b"):
@@ -119,21 +233,57 @@ class Labeler:
         elif key == ord("b"):
             self._move(-1)
         elif key == ord("s"):
-            self._save_curr_sample()
+            self._save_curr_sample(force=True)
+        elif key == ord("p"):
+            self.show_profile = not self.show_profile
 
     def run(self):
         cv2.namedWindow("img")
         cv2.setMouseCallback("img", _on_mouse_callback, self)
 
         self._load_curr_sample()
+        try:
+            self._run_loop()
+        finally:
+            # Ctrl-C等异常退出时, 也要把队列中的标注写入磁盘, 关闭trace文件
+            self._close()
+
+    def _close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.image_cache is not None:
+            self.image_cache.close()
+        self.ann_store.close()
+        if self.writer is not None:
+            self.writer.close()
+        self.profiler.close()
+
+    def _run_loop(self):
         while True:
-            display = self._draw_curr_image()
-            cv2.imshow("img", display)
-            key = cv2.waitKey(20)
+            self.profiler.begin_frame()
+            # 只有显示内容发生变化时才重新绘制, 空闲时几乎不占用CPU
+            if self.dirty:
+                self.dirty = False
+                with self.profiler.span("render"):
+                    with self.profiler.span("draw"):
+                        display = self._draw_curr_image()
+                    # 耗时统计每一帧都在变化, 所以不能画在缓存的图层中
+                    if self.show_profile:
+                        display = self._draw_profile(display)
+                    with self.profiler.span("imshow"):
+                        cv2.imshow("img", display)
+            # 鼠标事件在waitKey中处理
+            with self.profiler.span("wait_key"):
+                key = cv2.waitKey(20)
             if key == 27:
-                self._save_curr_sample()
+                self._save_curr_sample(force=True)
                 break
-            self._key_callback(key)
+            if key in (255, -1):
+                self._key_callback(key)
+            else:
+                with self.profiler.span("key"):
+                    self._key_callback(key)
+            self.profiler.end_frame(samples_id=self.samples_id)
 
 
 class ScaleLabeler(Labeler):
@@ -146,6 +296,15 @@ class ScaleLabeler(Labeler):
     'a':                 返回到原始图像
     鼠标滚轮:             放大/缩小图像
     鼠标左键按下拖动:      选择roi区域
+
+    显示图像分为三层绘制:
+    1. 底层: 缩放后的图像和文字, 只有缩放/平移或者换样本时才重新生成
+    2. 静态标注层: 在底层上画所有的标注, 标注被修改(self._modify())时
+       才重新生成, 继承类重载_draw_static_layer来画标注
+    3. 动态层: 光标, 选中的标注, 正在拖动的矩形等, 每一帧都在静态标注层
+       的拷贝上重新绘制, 继承类重载_draw_dynamic_layer来画这些内容
+    这样鼠标移动时每一帧的代价与标注的数量无关. 静态标注层中的内容如果
+    依赖其他的状态, 需要重载_static_layer_key把这些状态加进去.
     """
 
     def __init__(self, params, scale=1.0):
@@ -154,6 +313,12 @@ class ScaleLabeler(Labeler):
         self.curr_scale = scale
         self.curr_roi = None
         self.cache_roi = None
+        self.curr_pyramid = None
+        # 缓存的底层和静态标注层, 以及生成它们时的状态
+        self.base_layer = None
+        self.base_layer_key = None
+        self.static_layer = None
+        self.static_layer_key = None
 
     def _map_to(self, point):
         offset_x, offset_y = self.curr_roi.top_left
@@ -167,12 +332,38 @@ class ScaleLabeler(Labeler):
         y = point[1] / self.curr_scale + offset_y
         return int(round(x)), int(round(y))
 
+    def _map_points_to(self, points):
+        """批量的_map_to, points为N x 2的数组, 返回int32的N x 2数组."""
+
+        offset = np.array(self.curr_roi.top_left, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return np.round((points - offset) * self.curr_scale).astype(np.int32)
+
+    def _map_points_back(self, points):
+        """批量的_map_back, points为N x 2的数组, 返回int64的N x 2数组."""
+
+        offset = np.array(self.curr_roi.top_left, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return np.round(points / self.curr_scale + offset).astype(np.int64)
+
+    def _map_boxes_to(self, boxes):
+        """将N x 4的矩形映射到显示图像中, 每一行映射为(左上角, 右下角)."""
+
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        lower = np.minimum(boxes[:, 0:2], boxes[:, 2:4])
+        upper = np.maximum(boxes[:, 0:2], boxes[:, 2:4])
+        corners = np.concatenate([lower, upper], axis=1)
+        return self._map_points_to(corners).reshape(-1, 4)
+
     def _load_curr_sample(self):
         super()._load_curr_sample()
         height, width = self.curr_image.shape[:2]
         self.curr_roi = lib.labeler.BoundingBox(0, 0, width, height)
         self.curr_scale = self.base_scale
         self.cache_roi = None
+        self.curr_pyramid = lib.util.ImagePyramid(self.curr_image)
+        self.base_layer = self.static_layer = None
+        self.base_layer_key = self.static_layer_key = None
 
     def _draw_bounding_box(self, image, bbox, color, thickness):
         if bbox is None: return image
@@ -182,20 +373,58 @@ class ScaleLabeler(Labeler):
         cv2.rectangle(image, pt1, pt2, color, thickness=thickness)
         return image
 
+    def _draw_bounding_boxes(self, image, boxes, color, thickness):
+        # 批量的_draw_bounding_box, 同样跳过坐标为负的矩形
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        boxes = boxes[boxes.min(axis=1) >= 0]
+        boxes = self._map_boxes_to(boxes)
+        return lib.util.draw_rectangles(image, boxes, color, thickness)
+
     def _extract_image(self, image, roi):
-        x1, y1, x2, y2 = roi.bbox
-        image = image[y1:y2, x1:x2, :]
-        height, width = image.shape[:2]
-        new_height = int(round(height * self.curr_scale))
-        new_width = int(round(width * self.curr_scale))
-        image = cv2.resize(image, (new_width, new_height))
+        # 从金字塔中最接近当前scale的一层截取, 缩放的代价与原图大小无关
+        if self.curr_pyramid is None or self.curr_pyramid.image is not image:
+            self.curr_pyramid = lib.util.ImagePyramid(image)
+        return self.curr_pyramid.extract(roi.bbox, self.curr_scale)
+
+    def _base_layer_key(self):
+        # 底层的内容由样本, 缩放比例和roi决定
+        roi = self.curr_roi
+        roi_key = (roi.x1, roi.y1, roi.x2, roi.y2)
+        return (self.samples_id, self.curr_scale) + roi_key
+
+    def _static_layer_key(self):
+        return self._base_layer_key() + (self.curr_revision,)
+
+    def _get_base_layer(self):
+        key = self._base_layer_key()
+        if self.base_layer is None or self.base_layer_key != key:
+            with self.profiler.span("extract"):
+                show = self._extract_image(self.curr_image, self.curr_roi)
+            with self.profiler.span("text"):
+                self.base_layer = self._draw_text_lines(show)
+            self.base_layer_key = key
+        return self.base_layer
+
+    def _get_static_layer(self):
+        base = self._get_base_layer()
+        key = self._static_layer_key()
+        if self.static_layer is None or self.static_layer_key != key:
+            with self.profiler.span("static"):
+                self.static_layer = self._draw_static_layer(base.copy())
+            self.static_layer_key = key
+        return self.static_layer
+
+    def _draw_static_layer(self, image):
+        # 在这里画所有的标注, image可以直接修改
         return image
 
+    def _draw_dynamic_layer(self, image):
+        # 在这里画每一帧都可能变化的内容, image可以直接修改
+        return self._draw_bounding_box(image, self.cache_roi, (0, 0, 255), 1)
+
     def _draw_curr_image(self):
-        show = self._extract_image(self.curr_image, self.curr_roi)
-        show = self._draw_text_lines(show)
-        show = self._draw_bounding_box(show, self.cache_roi, (0, 0, 255), 1)
-        return show
+        show = self._get_static_layer().copy()
+        return self._draw_dynamic_layer(show)
 
     def _mouse_callback(self, event, x, y, flags):
         super()._mouse_callback(event, x, y, flags)
@@ -205,6 +434,7 @@ class ScaleLabeler(Labeler):
             self.cache_roi.x1 = x
             self.cache_roi.y1 = y
         elif event == cv2.EVENT_LBUTTONUP:
+            self._invalidate()
             if self.cache_roi is not None:
                 self.cache_roi.x2 = x
                 self.cache_roi.y2 = y
@@ -220,12 +450,15 @@ class ScaleLabeler(Labeler):
                 if self.cache_roi is not None:
                     self.cache_roi.x2 = x
                     self.cache_roi.y2 = y
-            else:
+                    self._invalidate()
+            elif self.cache_roi is not None:
                 self.cache_roi = None
+                self._invalidate()
         elif event == cv2.EVENT_MOUSEWHEEL:
             change = 0.02 if self.curr_scale < self.base_scale else 0.01
             scale = 1.0 - change if flags > 0 else 1.0 + change
             self.curr_scale *= scale
+            self._invalidate()
 
     def _key_callback(self, key):
         super()._key_callback(key)
@@ -0,0 +1,114 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import logging
+import threading
+import collections
+import concurrent.futures
+
+
+class SamplePrefetcher:
+    """样本预取类, 在后台线程中预先加载当前样本前后的若干个样本.
+
+    加载结果缓存在一个以samples_id为key的LRU cache中, 缓存大小有上限,
+    超出时淘汰最久未使用的样本.
+
+    Args:
+        load_fun: 加载函数, 定义如下: load_fun(samples_id), 返回加载好的样本.
+        num_samples: 样本总数.
+        ahead: 预取当前样本之后的样本个数.
+        behind: 预取当前样本之前的样本个数.
+        num_workers: 后台线程数.
+        capacity: cache的最大样本数, 0表示ahead + behind + 1.
+    """
+
+    def __init__(self,
+                 load_fun,
+                 num_samples,
+                 ahead=2,
+                 behind=1,
+                 num_workers=2,
+                 capacity=0):
+        assert ahead >= 0 and behind >= 0
+        self.load_fun = load_fun
+        self.num_samples = num_samples
+        self.ahead = ahead
+        self.behind = behind
+        self.capacity = max(capacity, ahead + behind + 1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _submit(self, samples_id):
+        # 调用者需要持有self.lock
+        if samples_id in self.cache:
+            self.cache.move_to_end(samples_id)
+        else:
+            future = self.executor.submit(self.load_fun, samples_id)
+            self.cache[samples_id] = future
+
+    def _evict(self, keep):
+        # 调用者需要持有self.lock
+        for samples_id in list(self.cache.keys()):
+            if len(self.cache) <= self.capacity: break
+            if samples_id in keep: continue
+            self.cache.pop(samples_id).cancel()
+
+    def get(self, samples_id):
+        """返回samples_id对应的样本, 并预取其前后的样本."""
+
+        with self.lock:
+            future = self.cache.get(samples_id)
+            if future is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.cache.move_to_end(samples_id)
+
+        # 没有命中时直接在当前线程中加载, 不用等待后台线程
+        if future is None:
+            sample = self.load_fun(samples_id)
+            future = concurrent.futures.Future()
+            future.set_result(sample)
+            with self.lock:
+                self.cache[samples_id] = future
+
+        window = [samples_id]
+        window += [samples_id + n for n in range(1, self.ahead + 1)]
+        window += [samples_id - n for n in range(1, self.behind + 1)]
+        window = [n for n in window if 0 <= n < self.num_samples]
+        with self.lock:
+            for n in reversed(window):
+                self._submit(n)
+            self._evict(set(window))
+        return future.result()
+
+    def invalidate(self, samples_id):
+        """样本被修改之后, 需要将其从cache中删除."""
+
+        with self.lock:
+            future = self.cache.pop(samples_id, None)
+        if future is not None: future.cancel()
+
+    def stats(self):
+        total = max(self.hits + self.misses, 1)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total,
+            "cached": len(self.cache),
+        }
+
+    def close(self):
+        logging.info("Prefetch stats: %s", self.stats())
+        with self.lock:
+            for future in self.cache.values():
+                future.cancel()
+            self.cache.clear()
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    pass
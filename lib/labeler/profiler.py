@@ -0,0 +1,89 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import json
+import time
+import collections
+import contextlib
+import numpy as np
+
+
+class FrameProfiler:
+    """Labeler主循环的计时工具.
+
+    主循环的每一次迭代为一帧, 帧内用span(name)纪录各个阶段的耗时, 同名的
+    span在一帧内累加, span可以嵌套. 只有做了事情的帧(画图, 按键, 鼠标等,
+    而不仅仅是等待waitKey)才会被纪录, 每个span保留最近window帧的耗时,
+    用来计算p50/p95.
+
+    trace_file不为None时, 每一帧纪录为一行json追加到文件中:
+    {"frame": 帧号, "time": 时间戳, "samples_id": 当前样本, "spans": {name: ms}}
+
+    Args:
+        trace_file: json lines格式的trace文件, None表示不输出.
+        window: 计算p50/p95时使用的最近的帧数.
+        idle_spans: 只包含这些span的帧不纪录.
+    """
+
+    def __init__(self, trace_file=None, window=300, idle_spans=("wait_key",)):
+        self.window = window
+        self.idle_spans = set(idle_spans)
+        self.history = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.window))
+        self.trace = None
+        self.files = contextlib.ExitStack()
+        if trace_file is not None:
+            self.trace = self.files.enter_context(
+                open(trace_file, "a", buffering=1, encoding="utf-8"))
+        self.num_frames = 0
+        self.curr_spans = {}
+
+    def begin_frame(self):
+        self.curr_spans = {}
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.curr_spans[name] = self.curr_spans.get(name, 0.0) + elapsed
+
+    def end_frame(self, **extra):
+        spans, self.curr_spans = self.curr_spans, {}
+        if set(spans) <= self.idle_spans: return
+        self.num_frames += 1
+        for name, elapsed in spans.items():
+            self.history[name].append(elapsed)
+        if self.trace is not None:
+            record = {"frame": self.num_frames, "time": time.time()}
+            record.update(extra)
+            record["spans"] = {
+                name: round(elapsed * 1000, 3)
+                for name, elapsed in spans.items()
+            }
+            self.trace.write(json.dumps(record) + "\n")
+
+    def percentiles(self, name, q=(50, 95)):
+        """返回name最近window帧耗时(毫秒)的百分位数, 没有纪录时返回None."""
+
+        if not self.history.get(name): return None
+        values = np.array(self.history[name]) * 1000
+        return np.percentile(values, q).tolist()
+
+    def summary_lines(self, names):
+        lines = []
+        for name in names:
+            values = self.percentiles(name)
+            if values is None: continue
+            lines.append(f"{name}: p50 {values[0]:.1f}ms p95 {values[1]:.1f}ms")
+        return lines
+
+    def close(self):
+        self.files.close()
+        self.trace = None
+
+
+if __name__ == "__main__":
+    pass
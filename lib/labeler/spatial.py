@@ -0,0 +1,136 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import math
+import collections
+
+
+class GridIndex:
+    """均匀网格空间索引, 用于鼠标的命中测试.
+
+    每一个元素由一个可hash的key表示, 其范围为矩形(x1, y1, x2, y2), 点的
+    范围为(x, y, x, y). 元素会被登记到与其范围相交的所有网格中, 查询时只需
+    要检查鼠标附近的网格. 添加和删除都是增量的, 同一个key可以添加多次,
+    删除同样的次数之后才会从索引中去掉.
+
+    Args:
+        cell_size: 网格的边长(像素).
+    """
+
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = collections.defaultdict(set)
+        self.bounds = {}
+        self.counts = {}
+        # 所有用到过的网格的范围, 只会扩大, 用来保证nearest的搜索会结束
+        self.extent = None
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __contains__(self, key):
+        return key in self.bounds
+
+    def _cell(self, x, y):
+        # 坐标可以是浮点数, 网格的序号必须是整数
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def _cells(self, bbox):
+        cx1, cy1 = self._cell(*bbox[:2])
+        cx2, cy2 = self._cell(*bbox[2:])
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                yield cx, cy
+
+    def add(self, key, bbox):
+        if key in self.bounds:
+            self.counts[key] += 1
+            return
+        x1, y1, x2, y2 = bbox
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+        bbox = x1, y1, x2, y2
+        self.bounds[key] = bbox
+        self.counts[key] = 1
+        for cell in self._cells(bbox):
+            self.cells[cell].add(key)
+        cx1, cy1 = self._cell(x1, y1)
+        cx2, cy2 = self._cell(x2, y2)
+        if self.extent is not None:
+            ex1, ey1, ex2, ey2 = self.extent
+            cx1, cy1 = min(cx1, ex1), min(cy1, ey1)
+            cx2, cy2 = max(cx2, ex2), max(cy2, ey2)
+        self.extent = cx1, cy1, cx2, cy2
+
+    def remove(self, key):
+        if key not in self.bounds: return
+        self.counts[key] -= 1
+        if self.counts[key] > 0: return
+        del self.counts[key]
+        for cell in self._cells(self.bounds.pop(key)):
+            self.cells[cell].discard(key)
+            if not self.cells[cell]: del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.bounds.clear()
+        self.counts.clear()
+        self.extent = None
+
+    def query_point(self, x, y):
+        """返回范围包含点(x, y)的所有key(包括边界)."""
+
+        cell = self._cell(x, y)
+        if cell not in self.cells: return []
+        selected = []
+        for key in self.cells[cell]:
+            x1, y1, x2, y2 = self.bounds[key]
+            if x1 <= x <= x2 and y1 <= y <= y2:
+                selected.append(key)
+        return selected
+
+    def nearest(self, x, y, max_dist=None):
+        """返回离点(x, y)最近的key及其距离的平方, 距离按照范围的中心计算.
+
+        max_dist不为None时, 只查找距离不超过max_dist的元素. 没有找到时
+        返回(None, None).
+        """
+
+        if not self.bounds: return None, None
+        cx, cy = self._cell(x, y)
+        ex1, ey1, ex2, ey2 = self.extent
+        max_ring = max(cx - ex1, ex2 - cx, cy - ey1, ey2 - cy)
+        if max_dist is not None:
+            max_ring = min(max_ring, int(max_dist) // self.cell_size + 1)
+        best_key, best_dist = None, None
+        for ring in range(0, max_ring + 1):
+            for cell in self._ring(cx, cy, ring):
+                for key in self.cells.get(cell, ()):
+                    x1, y1, x2, y2 = self.bounds[key]
+                    dist = ((x1 + x2) / 2 - x)**2 + ((y1 + y2) / 2 - y)**2
+                    if max_dist is not None and dist > max_dist**2:
+                        continue
+                    if best_dist is None or dist < best_dist:
+                        best_key, best_dist = key, dist
+            # 更外层的网格中的元素离(x, y)至少有ring * cell_size
+            if (best_dist is not None and
+                    best_dist <= (ring * self.cell_size)**2):
+                break
+        return best_key, best_dist
+
+    @staticmethod
+    def _ring(cx, cy, ring):
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
+
+
+if __name__ == "__main__":
+    pass
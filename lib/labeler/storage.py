@@ -0,0 +1,149 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+import lib.util
+
+
+class AnnotationStore:
+    """标注存储的基类, 每个样本的标注以样本名为key.
+
+    继承本类时需要实现load, save和names, 标注为可以保存为json的数据.
+    """
+
+    def load(self, name):
+        """返回样本name的标注, 不存在时返回None."""
+        raise NotImplementedError
+
+    def save(self, name, annotations):
+        raise NotImplementedError
+
+    def names(self):
+        """返回所有已保存标注的样本名."""
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class JsonFileStore(AnnotationStore):
+    """每个样本一个json文件: <ann_dir>/<name>.json.
+
+    如果给定了writer(lib.util.AsyncJsonWriter), 则在后台线程中保存.
+    """
+
+    def __init__(self, ann_dir, writer=None):
+        self.ann_dir = ann_dir
+        self.writer = writer
+
+    def _path(self, name):
+        return os.path.join(self.ann_dir, name + ".json")
+
+    def load(self, name):
+        path = self._path(name)
+        # 还没有写入磁盘的标注要从writer中读取
+        if self.writer is not None: return self.writer.read(path)
+        if not os.path.exists(path): return None
+        return lib.util.read_json_file(path)
+
+    def save(self, name, annotations):
+        path = self._path(name)
+        if self.writer is not None:
+            self.writer.write(annotations, path)
+        else:
+            lib.util.write_json_file(annotations, path, atomic=True)
+
+    def names(self):
+        names = []
+        for root, _, files in os.walk(self.ann_dir):
+            for filename in files:
+                if not filename.endswith(".json"): continue
+                path = os.path.join(root, filename[:-len(".json")])
+                names.append(os.path.relpath(path, self.ann_dir))
+        return sorted(names)
+
+    def flush(self):
+        if self.writer is not None: self.writer.flush()
+
+
+class SqliteStore(AnnotationStore):
+    """所有样本的标注保存在一个SQLite数据库中.
+
+    每次save()都提交事务, 与JsonFileStore一样, 快照中纪录的已保存样本的
+    标注不会因为程序崩溃而丢失. 数据库使用WAL模式, 每次提交只追加写日志,
+    代价很小.
+    """
+
+    def __init__(self, path):
+        lib.util.prepare_dir(path)
+        self.path = path
+        # 预取时会在其他线程中读取, 所以这里用锁来保护连接
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS annotations "
+                          "(name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.commit()
+
+    def load(self, name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM annotations WHERE name = ?",
+                (name,)).fetchone()
+        if row is None: return None
+        return json.loads(row[0])
+
+    def save(self, name, annotations):
+        data = json.dumps(annotations)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO annotations (name, data) "
+                "VALUES (?, ?)", (name, data))
+            self.conn.commit()
+
+    def names(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT name FROM annotations ORDER BY name").fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_annotation_store(backend, path, writer=None):
+    """根据backend创建AnnotationStore, backend可以为: json, sqlite."""
+
+    if backend == "json":
+        return JsonFileStore(path, writer)
+    if backend == "sqlite":
+        return SqliteStore(path)
+    assert False, f"Unknown annotation backend: {backend}"
+
+
+def convert_annotations(src, dst, names=None):
+    """将src中的标注拷贝到dst中, names为None时拷贝所有的标注."""
+
+    count = 0
+    for name in (src.names() if names is None else names):
+        annotations = src.load(name)
+        if annotations is None: continue
+        dst.save(name, annotations)
+        count += 1
+    dst.flush()
+    logging.info("Converted %d annotations.", count)
+    return count
+
+
+if __name__ == "__main__":
+    pass
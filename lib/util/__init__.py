@@ -1,7 +1,12 @@
 #! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
 # coding: utf-8
 
+from lib.util.checkpoint import *
 from lib.util.common import *
+from lib.util.imgcache import *
 from lib.util.imgutil import *
 from lib.util.multitask import *
 from lib.util.parser import *
+from lib.util.samplelist import *
+from lib.util.sharedmem import *
+from lib.util.writer import *
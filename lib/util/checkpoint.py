@@ -0,0 +1,129 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import os
+import time
+import pickle
+import logging
+import contextlib
+import numpy as np
+
+
+class Checkpoint:
+    """TaskPool的断点文件, 纪录已经完成的样本的(sid, result).
+
+    文件只会在结尾追加, 每条纪录为: [sid, 数据长度](两个uint64)加上pickle
+    之后的result. 与Labeler的snapshot类似, 程序中断之后重新运行时, 已经
+    完成的样本直接从这里读取结果, 不再重新处理. 打开时扫描一遍文件建立
+    sid到位置的索引, 被中断时没有写完的最后一条纪录会被截掉.
+
+    新的结果先缓存在内存中, 每隔flush_interval秒写入一次磁盘, 所以中断时
+    最多丢失这段时间的结果. sid是样本在samples中的序号, 所以重新运行时
+    samples的顺序必须和原来一样. 本次运行中add的结果也可以用in和[]查询.
+
+    可以用作context manager, 退出时调用close().
+
+    Args:
+        path: 断点文件.
+        flush_interval: 写入磁盘的时间间隔(秒).
+    """
+
+    header = np.dtype([("sid", "<u8"), ("size", "<u8")])
+
+    def __init__(self, path, flush_interval=10.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.sids, self.offsets = self._load_index()
+        # 本次运行中add的纪录: {sid: 在文件中的位置}, 位置不小于
+        # flushed_size的纪录还在buffer中
+        self.added = {}
+        self.buffer = []
+        self.flush_time = time.time()
+        self.files = contextlib.ExitStack()
+        self.file = self.files.enter_context(open(path, "ab"))
+        self.flushed_size = self.size = self.file.tell()
+        self.reader = self.files.enter_context(open(path, "rb"))
+        if len(self.sids) > 0:
+            logging.info("Loaded %d results from checkpoint: %s",
+                         len(self.sids),
+                         path)
+
+    def _load_index(self):
+        sids, offsets = [], []
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            with open(self.path, "rb") as srcfile:
+                offset = 0
+                while offset + self.header.itemsize <= size:
+                    header = np.frombuffer(
+                        srcfile.read(self.header.itemsize), self.header)[0]
+                    end = offset + self.header.itemsize + int(header["size"])
+                    if end > size: break
+                    sids.append(int(header["sid"]))
+                    offsets.append(offset)
+                    offset = end
+                    srcfile.seek(offset)
+            if offset < size:
+                logging.warning("Truncate incomplete checkpoint: %s", self.path)
+                os.truncate(self.path, offset)
+        sids = np.array(sids, dtype=np.int64)
+        offsets = np.array(offsets, dtype=np.int64)
+        order = np.argsort(sids, kind="stable")
+        return sids[order], offsets[order]
+
+    def _find(self, sid):
+        """返回sid的纪录在文件中的位置, 不存在时返回None."""
+
+        if sid in self.added: return self.added[sid]
+        index = np.searchsorted(self.sids, sid)
+        if index < len(self.sids) and self.sids[index] == sid:
+            return int(self.offsets[index])
+        return None
+
+    def __len__(self):
+        return len(self.sids) + len(self.added)
+
+    def __contains__(self, sid):
+        return self._find(sid) is not None
+
+    def __getitem__(self, sid):
+        offset = self._find(sid)
+        if offset is None: raise KeyError(sid)
+        if offset >= self.flushed_size: self.flush()
+        self.reader.seek(offset)
+        header = np.frombuffer(
+            self.reader.read(self.header.itemsize), self.header)[0]
+        return pickle.loads(self.reader.read(int(header["size"])))
+
+    def add(self, sid, result):
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        header = np.array([(sid, len(data))], dtype=self.header)
+        self.buffer.append(header.tobytes() + data)
+        self.added[sid] = self.size
+        self.size += len(self.buffer[-1])
+        if time.time() - self.flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(b"".join(self.buffer))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer = []
+            self.flushed_size = self.size
+        self.flush_time = time.time()
+
+    def close(self):
+        if self.file.closed: return
+        self.flush()
+        self.files.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    pass
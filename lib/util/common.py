@@ -6,6 +6,7 @@ import json
 import pickle
 import logging
 import datetime
+import threading
 import multiprocessing
 
 global_lock = multiprocessing.Lock()
@@ -75,12 +76,26 @@ def write_pickle_file(data, path):
         pickle.dump(data, dstfile, protocol=2)
 
 
-def write_json_file(data, path):
-    """Write data to json file."""
+def write_json_file(data, path, atomic=False):
+    """Write data to json file.
+
+    If atomic is True, data is written to a temporary file first and then
+    renamed to path, so readers never see a truncated file.
+    """
 
     prepare_dir(path)
-    with open(path, "w") as dstfile:
-        json.dump(data, dstfile, indent=2)
+    if not atomic:
+        with open(path, "w") as dstfile:
+            json.dump(data, dstfile, indent=2)
+        return None
+
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "w") as dstfile:
+            json.dump(data, dstfile, indent=2)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path): os.remove(temp_path)
 
 
 def write_list_file(data, path, sep=" "):
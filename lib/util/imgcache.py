@@ -0,0 +1,142 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import collections
+import cv2
+import numpy as np
+
+
+class DecodedImageCache:
+    """解码之后图像的磁盘缓存.
+
+    每一幅图像解码之后以.npy格式保存为一个文件, 再次读取时直接返回一个
+    只读的np.memmap, 不需要重新解码. 缓存的总大小超过max_bytes时, 按照
+    LRU的顺序删除. 源文件的mtime或者大小发生变化时, 对应的缓存失效.
+
+    cache_dir中的index.json纪录了所有缓存的信息, 格式为:
+    [[key, filename, mtime_ns, size, nbytes], ...], 按照最近使用的顺序排列.
+    index.json不是每次put都重写, 而是在删除缓存, 距离上次保存超过
+    save_interval秒或者close()时保存. 程序中断时没有纪录到index.json中
+    的缓存文件, 会在再次缓存同一幅图像时被覆盖.
+
+    Args:
+        cache_dir: 缓存目录.
+        max_bytes: 缓存的最大字节数.
+        save_interval: 保存index.json的最小时间间隔(秒).
+    """
+
+    def __init__(self, cache_dir, max_bytes=4 << 30, save_interval=5.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.save_interval = save_interval
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.dirty = False
+        self.save_time = time.time()
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r", encoding="utf-8") as srcfile:
+                index = json.load(srcfile)
+            for key, *entry in index:
+                self.entries[key] = entry
+                self.total_bytes += entry[-1]
+
+    def _path(self, filename):
+        return os.path.join(self.cache_dir, filename)
+
+    def _save_index(self):
+        # 调用者需要持有self.lock
+        index = [[key, *entry] for key, entry in self.entries.items()]
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as dstfile:
+            json.dump(index, dstfile)
+        os.replace(temp_file, self.index_file)
+        self.dirty = False
+        self.save_time = time.time()
+
+    def _remove(self, key):
+        # 调用者需要持有self.lock
+        filename, _, _, nbytes = self.entries.pop(key)
+        self.total_bytes -= nbytes
+        self.dirty = True
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+
+    def get(self, path, flags=1):
+        """返回缓存中的图像, 缓存或者源文件不存在, 或者缓存已失效时返回
+        None."""
+
+        key = f"{os.path.abspath(path)}:{flags}"
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            filename, mtime_ns, size, _ = entry
+            if mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            self.dirty = True
+        try:
+            return np.load(self._path(filename), mmap_mode="r")
+        except (OSError, ValueError):
+            logging.warning("Broken image cache: %s", filename)
+            with self.lock:
+                if key in self.entries: self._remove(key)
+            return None
+
+    def put(self, path, image, flags=1):
+        key = f"{os.path.abspath(path)}:{flags}"
+        stat = os.stat(path)
+        if image.nbytes > self.max_bytes: return
+        filename = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npy"
+        # 先写临时文件再改名, 避免其他进程读到不完整的文件
+        temp_file = self._path(filename + f".{threading.get_ident()}.tmp")
+        with open(temp_file, "wb") as dstfile:
+            np.save(dstfile, image, allow_pickle=False)
+        os.replace(temp_file, self._path(filename))
+        with self.lock:
+            # 文件名只与key有关, 旧的文件已经被覆盖, 这里只需要删除纪录
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[-1]
+            self.entries[key] = [
+                filename, stat.st_mtime_ns, stat.st_size, image.nbytes
+            ]
+            self.total_bytes += image.nbytes
+            evicted = self.total_bytes > self.max_bytes
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+            self.dirty = True
+            # 删除的缓存文件要马上从index.json中去掉
+            if evicted or time.time() - self.save_time >= self.save_interval:
+                self._save_index()
+
+    def imread(self, path, flags=1):
+        """与cv2.imread相同, 但优先从缓存中读取."""
+
+        image = self.get(path, flags)
+        if image is not None: return image
+        image = cv2.imread(path, flags)
+        if image is not None: self.put(path, image, flags)
+        return image
+
+    def close(self):
+        with self.lock:
+            if self.dirty: self._save_index()
+
+
+if __name__ == "__main__":
+    pass
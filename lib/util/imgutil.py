@@ -1,6 +1,7 @@
 #! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
 # coding: utf-8
 
+import functools
 import cv2
 import numpy as np
 
@@ -10,20 +11,85 @@ import PIL.ImageFont
 import PIL.ImageDraw
 
 
-def draw_textlines(image, origin, textlines, color, size=26, thickness=2):
-    """在图片上写文字, 支持中文."""
+@functools.lru_cache(maxsize=None)
+def _get_font(path, size):
+    return PIL.ImageFont.truetype(path, size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_text_mask(text, size, thickness, font):
+    """将一行文字光栅化为alpha mask, 坐标原点与draw.text()的一致."""
+
+    font = _get_font(font, size)
+    _, _, right, bottom = font.getbbox(text)
+    width, height = max(right, 0) + thickness, max(bottom, 0) + thickness
+    mask = PIL.Image.new("L", (width, height), 0)
+    draw = PIL.ImageDraw.Draw(mask)
+    for i in range(0, thickness):
+        for j in range(0, thickness):
+            draw.text((i, j), text, font=font, fill=255)
+    mask = np.array(mask, dtype=np.uint16)
+    mask.setflags(write=False)
+    return mask
+
+
+def _blend_mask(image, mask, origin, color):
+    # 只在文字所在的区域内混合, 超出图像的部分直接裁掉
+    height, width = image.shape[:2]
+    x1, y1 = max(origin[0], 0), max(origin[1], 0)
+    x2 = min(origin[0] + mask.shape[1], width)
+    y2 = min(origin[1] + mask.shape[0], height)
+    if x1 >= x2 or y1 >= y2: return
+    alpha = mask[y1 - origin[1]:y2 - origin[1], x1 - origin[0]:x2 - origin[0]]
+    color = np.array(color, dtype=np.uint16).reshape(-1)
+    if image.ndim == 3:
+        alpha = alpha[:, :, None]
+        color = color[:image.shape[2]]
+    else:
+        color = color[0]
+    region = image[y1:y2, x1:x2]
+    blended = (region * (255 - alpha) + color * alpha + 127) // 255
+    region[...] = blended.astype(image.dtype)
+
+
+def draw_textlines(image,
+                   origin,
+                   textlines,
+                   color,
+                   size=26,
+                   thickness=2,
+                   font="simsun.ttc",
+                   inplace=False):
+    """在图片上写文字, 支持中文.
+
+    字体和光栅化之后的文字都会被缓存, 每次只在文字所在的区域内做alpha混合.
+    inplace为True时直接在image上绘制, 否则在image的拷贝上绘制.
+    """
 
-    img = PIL.Image.fromarray(image)
-    draw = PIL.ImageDraw.Draw(img)
-    font = PIL.ImageFont.truetype('simsun.ttc', size)
+    if not inplace: image = image.copy()
     if isinstance(textlines, str): textlines = [textlines]
     for n, text in enumerate(textlines):
+        if not text: continue
         offset_y = n * size + thickness
-        for i in range(0, thickness):
-            for j in range(0, thickness):
-                org = (origin[0] + i, origin[1] + j + offset_y)
-                draw.text(org, text, font=font, fill=color)
-    return np.array(img)
+        mask = _get_text_mask(text, size, thickness, font)
+        _blend_mask(image, mask, (origin[0], origin[1] + offset_y), color)
+    return image
+
+
+def draw_rectangles(image, boxes, color, thickness=1):
+    """批量画矩形, boxes为N x 4的数组, 每一行为(x1, y1, x2, y2).
+
+    所有矩形的边框通过一次cv2.polylines画出, 结果与逐个调用cv2.rectangle
+    一致, 但是没有每个矩形一次的python调用开销. 直接在image上绘制,
+    thickness必须大于0.
+    """
+
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    if len(boxes) == 0: return image
+    x1, y1, x2, y2 = boxes.astype(np.int32).T
+    corners = np.stack([x1, y1, x2, y1, x2, y2, x1, y2], axis=1)
+    cv2.polylines(image, corners.reshape(-1, 4, 2), True, color, thickness)
+    return image
 
 
 def stitch_images(images, width=512, height=384, fill=(0, 0, 0)):
@@ -71,6 +137,55 @@ def stitch_images(images, width=512, height=384, fill=(0, 0, 0)):
     return stitched
 
 
+class ImagePyramid:
+    """图像金字塔, 第n层的宽高为原图的1/2^n, 每一层在第一次用到时才计算.
+
+    缩小显示时从最接近目标scale(且不小于scale)的一层中截取roi, 这样只需要
+    对一个很小的图像做resize, 其耗时与原图的大小无关.
+
+    Args:
+        image: cv2格式的原图.
+        min_size: 最小一层的短边不小于min_size.
+    """
+
+    def __init__(self, image, min_size=32):
+        self.image = image
+        self.min_size = min_size
+        self.levels = [image]
+
+    def get_level(self, level):
+        while len(self.levels) <= level:
+            height, width = self.levels[-1].shape[:2]
+            size = ((width + 1) // 2, (height + 1) // 2)
+            self.levels.append(
+                cv2.resize(self.levels[-1], size, interpolation=cv2.INTER_AREA))
+        return self.levels[level]
+
+    def select_level(self, scale):
+        level = 0
+        min_side = min(self.image.shape[:2])
+        while scale <= 0.5**(level + 1):
+            if (min_side >> (level + 1)) < self.min_size: break
+            level += 1
+        return level
+
+    def extract(self, roi, scale):
+        """截取roi(相对于原图, 格式为x1, y1, x2, y2)并缩放scale倍."""
+
+        height, width = self.image.shape[:2]
+        x1, y1 = max(roi[0], 0), max(roi[1], 0)
+        x2, y2 = min(roi[2], width), min(roi[3], height)
+        new_width = int(round((x2 - x1) * scale))
+        new_height = int(round((y2 - y1) * scale))
+
+        level = self.select_level(scale)
+        factor = 2**level
+        image = self.get_level(level)
+        image = image[y1 // factor:-(-y2 // factor),
+                      x1 // factor:-(-x2 // factor)]
+        return cv2.resize(image, (new_width, new_height))
+
+
 def get_label_color_map(labels):
     """给每一个label生成一个color.
 
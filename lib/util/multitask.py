@@ -2,36 +2,329 @@
 # coding: utf-8
 
 import time
+import queue
+import pickle
+import asyncio
+import inspect
 import logging
+import threading
+import traceback
+import concurrent.futures
 import multiprocessing
 
-
-class TaskProcess(multiprocessing.Process):
-    """进程类, 不同的进程可以用不同的初始化参数.
-
-    这个类将资源的初始化工作放到进程开始之后执行, 避免了进程间数据的拷贝.
+from lib.util.checkpoint import Checkpoint
+from lib.util.taskqueue import _AsyncInputQueue
+from lib.util.taskqueue import _EventLoopThread
+from lib.util.taskqueue import _LocalResultQueue
+from lib.util.taskqueue import _ResultQueue
+from lib.util.taskschedule import _Chunk
+from lib.util.taskschedule import _ChunkTuner
+from lib.util.taskschedule import _iter_chunks
+from lib.util.taskschedule import _ReorderBuffer
+from lib.util.taskschedule import _Scheduler
+from lib.util.taskschedule import _WorkerStatus
+
+
+class _TaskWorker:
+    """TaskProcess和TaskThread共用的处理循环.
+
+    资源的初始化工作放到worker开始之后执行, 对于进程来说避免了进程间数据
+    的拷贝. process抛出的异常不会让worker退出, 而是以TaskFailure作为结果
+    返回. 每个worker有自己的输入队列, status(_WorkerStatus)中纪录了本
+    worker正在处理的样本, 用于检测超时以及确定worker退出时是哪个样本
+    导致的.
     """
 
-    def __init__(self, task_class, task_args, input_queue, output_queue):
-        super().__init__()
+    # 超时之后被放弃的worker(无法杀掉的线程)不能再修改status和返回结果
+    killed = False
+
+    def __init__(self,
+                 task_class,
+                 task_args,
+                 input_queue,
+                 output_queue,
+                 transport,
+                 worker_id,
+                 status):
         assert hasattr(task_class, "process")
         self.task_class = task_class
         self.task_args = task_args
         self.input_queue = input_queue
         self.output_queue = output_queue
+        self.transport = transport
+        self.worker_id = worker_id
+        self.status = status
 
-    def run(self):
+    def _create_task(self):
         if isinstance(self.task_args, tuple):
-            task = self.task_class(*self.task_args)
-        else:
-            task = self.task_class(self.task_args)
-        while True:
+            return self.task_class(*self.task_args)
+        return self.task_class(self.task_args)
+
+    def _ready(self):
+        # task_class初始化成功, 之后再退出就不算初始化失败
+        if self.status is not None: self.status.ready[self.worker_id] = 1
+
+    def run(self):
+        task = self._create_task()
+        self._ready()
+        while not self.killed:
+            start_time = time.time()
             sid, sample = self.input_queue.get()
-            if sample is None: break
-            if isinstance(sample, tuple):
-                self.output_queue.put((sid, task.process(*sample)))
+            # 用sid判断是否退出, 这样sample本身也可以为None
+            if sid is None: break
+            self._begin(sid, waited=time.time() - start_time)
+            start_time = time.time()
+            if isinstance(sample, _Chunk):
+                result = _Chunk()
+                for index, item in enumerate(sample):
+                    self._begin(sid, index > 0)
+                    result.append(self._process(task, sid + index, item))
+                result.elapsed = time.time() - start_time
+            else:
+                result = self._process(task, sid, sample)
+            self._send(sid, result, time.time() - start_time)
+
+    def _begin(self, sid, restart=False, waited=0.0):
+        if self.status is None or self.killed: return
+        self.status.begin(self.worker_id, sid, restart, waited)
+
+    def _send(self, sid, result, elapsed):
+        if self.killed: return
+        if self.status is not None:
+            count = len(result) if isinstance(result, _Chunk) else 1
+            self.status.processed(self.worker_id, count, elapsed)
+            self.status.sending(self.worker_id)
+        # 在put之前交出共享内存块, put中途退出时最多丢失这些块, 而不会
+        # 出现同一个块被父进程使用的同时又被放回空闲队列
+        if self.transport is not None: self.transport.sent(self.worker_id)
+        self.output_queue.put((sid, result))
+        if self.status is not None: self.status.end(self.worker_id)
+
+    def _process(self, task, sid, sample):
+        try:
+            result = _process_sample(task, sample)
+        except Exception as exc:  # pylint: disable=broad-except
+            return TaskFailure.from_exception(sid, exc)
+        if self.transport is None: return result
+        return self.transport.encode(result, self.worker_id)
+
+
+class TaskProcess(_TaskWorker, multiprocessing.Process):
+    """进程类, 不同的进程可以用不同的初始化参数. 参考_TaskWorker."""
+
+    def __init__(self,
+                 task_class,
+                 task_args,
+                 input_queue,
+                 output_queue,
+                 transport=None,
+                 worker_id=0,
+                 status=None):
+        multiprocessing.Process.__init__(self)
+        _TaskWorker.__init__(self,
+                             task_class,
+                             task_args,
+                             input_queue,
+                             output_queue,
+                             transport,
+                             worker_id,
+                             status)
+
+
+class TaskThread(_TaskWorker, threading.Thread):
+    """线程版本的TaskProcess, 适合I/O密集或者会释放GIL的任务.
+
+    线程不能被杀掉, 超时的线程会被放弃(daemon线程, 不会阻止程序退出),
+    它返回的结果会被忽略. 初始化task_class时抛出异常会让线程退出.
+    """
+
+    sentinel = None
+
+    def __init__(self,
+                 task_class,
+                 task_args,
+                 input_queue,
+                 output_queue,
+                 transport=None,
+                 worker_id=0,
+                 status=None):
+        threading.Thread.__init__(self, daemon=True)
+        _TaskWorker.__init__(self,
+                             task_class,
+                             task_args,
+                             input_queue,
+                             output_queue,
+                             transport,
+                             worker_id,
+                             status)
+        self.exitcode = None
+
+    def run(self):
+        try:
+            super().run()
+            self.exitcode = 0
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Worker %d failed.", self.worker_id)
+            self.exitcode = 1
+        finally:
+            self.output_queue.interrupt()
+
+    def kill(self):
+        self.killed = True
+
+
+class _AsyncTaskWorker(_TaskWorker):
+    """asyncio版本的worker, 是在事件循环中运行的一个协程.
+
+    task_class的process可以是普通函数, 也可以是协程函数. 所有的worker
+    在同一个线程的事件循环中运行, 接口与TaskProcess相同, kill()会取消
+    这个协程. 普通函数在worker自己的线程池中执行, 以免阻塞事件循环和其他
+    worker. 超时的普通函数不能被停止, 它所在的线程会被放弃.
+    """
+
+    sentinel = None
+
+    def __init__(self,
+                 task_class,
+                 task_args,
+                 input_queue,
+                 output_queue,
+                 transport=None,
+                 worker_id=0,
+                 status=None):
+        _TaskWorker.__init__(self,
+                             task_class,
+                             task_args,
+                             input_queue,
+                             output_queue,
+                             transport,
+                             worker_id,
+                             status)
+        self.future = None
+        self.exitcode = None
+
+    def start(self):
+        self.future = asyncio.run_coroutine_threadsafe(self._run_async(),
+                                                       self.input_queue.loop)
+        self.future.add_done_callback(self._done)
+
+    def _done(self, future):
+        failed = future.cancelled() or future.exception() is not None
+        if failed and not future.cancelled():
+            logging.error("Worker %d failed: %r",
+                          self.worker_id,
+                          future.exception())
+        self.exitcode = 1 if failed else 0
+        self.output_queue.interrupt()
+
+    def is_alive(self):
+        return not self.future.done()
+
+    def kill(self):
+        self.killed = True
+        self.future.cancel()
+
+    def join(self, timeout=None):
+        concurrent.futures.wait([self.future], timeout)
+
+    async def _run_async(self):
+        task = self._create_task()
+        self._ready()
+        executor = None
+        if not inspect.iscoroutinefunction(task.process):
+            executor = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            while not self.killed:
+                start_time = time.time()
+                sid, sample = await self.input_queue.get()
+                if sid is None: break
+                self._begin(sid, waited=time.time() - start_time)
+                start_time = time.time()
+                if isinstance(sample, _Chunk):
+                    result = _Chunk()
+                    for index, item in enumerate(sample):
+                        self._begin(sid, index > 0)
+                        result.append(await self._process_async(
+                            task, sid + index, item, executor))
+                    result.elapsed = time.time() - start_time
+                else:
+                    result = await self._process_async(task,
+                                                       sid,
+                                                       sample,
+                                                       executor)
+                self._send(sid, result, time.time() - start_time)
+        finally:
+            # 被取消时不等待还在执行的普通函数
+            if executor is not None: executor.shutdown(wait=False)
+
+    async def _process_async(self, task, sid, sample, executor):
+        try:
+            if executor is None:
+                result = await _process_sample(task, sample)
             else:
-                self.output_queue.put((sid, task.process(sample)))
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(executor,
+                                                    _process_sample,
+                                                    task,
+                                                    sample)
+        except Exception as exc:  # pylint: disable=broad-except
+            return TaskFailure.from_exception(sid, exc)
+        return result
+
+
+class TaskFailure:
+    """处理失败的样本在结果中的占位.
+
+    Attributes:
+        sid: 样本的序号.
+        error: 失败的原因, 为process抛出的异常, 或者进程退出/超时时的
+            RuntimeError.
+        traceback: 异常的traceback, 进程退出/超时时为空字符串.
+    """
+
+    def __init__(self, sid, error, message=""):
+        self.sid = sid
+        self.error = error
+        self.traceback = message
+
+    @staticmethod
+    def from_exception(sid, exc):
+        message = traceback.format_exc()
+        # 有些异常不能pickle, 这时只能用RuntimeError代替
+        try:
+            pickle.dumps(exc)
+        except Exception:  # pylint: disable=broad-except
+            exc = RuntimeError(repr(exc))
+        return TaskFailure(sid, exc, message)
+
+    def __repr__(self):
+        return f"TaskFailure({self.sid}, {self.error!r})"
+
+
+def _process_sample(task, sample):
+    if isinstance(sample, tuple): return task.process(*sample)
+    return task.process(sample)
+
+
+class ProgressLogger:
+    """默认的进度回调, 每隔interval秒打印一次进度.
+
+    进度回调的定义为: progress(num_done, num_total), 当samples没有长度时
+    num_total为None.
+    """
+
+    def __init__(self, name, interval=5):
+        self.name = name
+        self.interval = interval
+        self.start_time = time.time()
+
+    def __call__(self, num_done, num_total):
+        if time.time() - self.start_time <= self.interval: return
+        if num_total is None:
+            logging.info("Progress (%s) %d", self.name, num_done)
+        else:
+            logging.info("Progress (%s) %d/%d", self.name, num_done, num_total)
+        self.start_time = time.time()
 
 
 class _ProxyTaskClass:
@@ -45,6 +338,17 @@ class _ProxyTaskClass:
         return self.taskfun(*sample, *self.args)
 
 
+class _AsyncProxyTaskClass:
+    """协程函数版本的_ProxyTaskClass, asyncio后端直接在事件循环中执行."""
+
+    def __init__(self, taskfun, args):
+        self.args = args if isinstance(args, tuple) else (args,)
+        self.taskfun = taskfun
+
+    async def process(self, *sample):
+        return await self.taskfun(*sample, *self.args)
+
+
 class TaskPool:
     """带初始化的多进程Pool.
 
@@ -61,16 +365,69 @@ class TaskPool:
             同样的, 如果task_args中的项为tuple类型, 会将其展开. 如果
             task_class的初始化函数不需要参数, 则task_args中的每一项为一个
             空的tuple.
+        transport: 返回结果的方式, 为None时通过pickle返回. 结果中有很大
+            的np.ndarray时, 可以用SharedArrayTransport通过共享内存返回.
+            finish()时会关闭transport.
+        timeout: 每个样本的最长处理时间(秒), 超时的进程会被杀掉. 为None时
+            不限制.
+        max_retries: 进程退出(比如段错误, 内存不足被杀掉)或者超时的样本
+            最多重试的次数. process抛出的异常不会重试.
+        backend: 执行的方式, 可以为:
+            process: 每个task_args对应一个子进程.
+            thread: 每个task_args对应一个线程(TaskThread), 适合I/O密集或者
+                会释放GIL的任务(比如cv2.imread), 没有创建进程和pickle的开销.
+            asyncio: 每个task_args对应事件循环中的一个协程, process可以是
+                协程函数. 所有的协程在同一个线程中运行.
+            三种方式对task_class和task_args的要求相同. 只有process支持
+            transport.
+        return_failures: 为False时, 样本失败(process抛出异常, 或者重试
+            次数用完)会在取回处理中的样本之后, 在调用者中抛出对应的异常.
+            为True时不抛出异常, 失败的样本的结果为TaskFailure.
+
+    子进程退出或者超时之后, 会用原来的task_args启动一个新的进程代替它.
+    同一个worker连续max_init_failures次在初始化task_class时退出, 说明
+    task_args有问题, 这时杀掉所有的worker并抛出RuntimeError.
     """
 
-    def __init__(self, task_class, task_args):
+    check_interval = 1.0
+    max_init_failures = 3
+    worker_classes = {
+        "process": TaskProcess,
+        "thread": TaskThread,
+        "asyncio": _AsyncTaskWorker,
+    }
+
+    def __init__(self,
+                 task_class,
+                 task_args,
+                 transport=None,
+                 timeout=None,
+                 max_retries=1,
+                 backend="process",
+                 return_failures=False):
         assert hasattr(task_class, "process")
         # 这里task_args是一个参数列表, 其中的一项才是task_class的初始化参数
         assert isinstance(task_args, (tuple, list))
-        self.input_queue = multiprocessing.Queue()
-        self.output_queue = multiprocessing.Queue()
-        # 如果线程数是1, 就直接串行处理
-        self.is_single_thread = (len(task_args) <= 1)
+        assert backend in self.worker_classes, f"Unknown backend: {backend}"
+        assert transport is None or backend == "process", \
+            "transport is only supported by the process backend."
+        self.task_class = task_class
+        self.task_args = task_args
+        self.backend = backend
+        self.event_loop = None
+        if backend == "process":
+            self.output_queue = _ResultQueue()
+        else:
+            self.output_queue = _LocalResultQueue()
+            if backend == "asyncio": self.event_loop = _EventLoopThread()
+        self.transport = transport
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.return_failures = return_failures
+        if timeout is not None:
+            self.check_interval = min(self.check_interval, timeout / 4)
+        # 如果线程数是1, 就直接串行处理. 协程必须在事件循环中运行
+        self.is_single_thread = (len(task_args) <= 1 and backend != "asyncio")
 
         if self.is_single_thread:
             if isinstance(task_args[0], tuple):
@@ -78,110 +435,420 @@ class TaskPool:
             else:
                 self.task_instance = task_class(task_args[0])
         else:
-            self.processes = []
-            for args in task_args:
-                self.processes.append(
-                    TaskProcess(task_class,
-                                args,
-                                self.input_queue,
-                                self.output_queue))
-                self.processes[-1].start()
-
-    def process(self, samples, batch_size=0):
-        """多进程批量处理函数, 类似于pool.map.
-
-        如果samples个数太多, 一次性装入input_queue可能会导致内存不足.
-        所以这里采用batch的方式: 当input_queue的大小小于batch_size的时候,
-        就往里面装batch_size个样本. 不直接使用queue的阻塞机制是为了实时
-        打印进度.
+            self.status = _WorkerStatus(len(task_args))
+            self.processes = [None] * len(task_args)
+            self.input_queues = [None] * len(task_args)
+            # 分配给每个worker, 还没有返回结果的样本数
+            self.assigned = [0] * len(task_args)
+            self.init_failures = [0] * len(task_args)
+            for worker_id in range(len(task_args)):
+                self._start_worker(worker_id)
+        # 正在处理的样本: {sid: [sample或者_Chunk, 已经重试的次数, worker_id]}
+        self.pending = {}
+        self.num_pending_items = 0
+
+    def _new_input_queue(self):
+        if self.backend == "process": return multiprocessing.Queue()
+        if self.backend == "thread": return queue.Queue()
+        return _AsyncInputQueue(self.event_loop.loop)
+
+    def _start_worker(self, worker_id):
+        # 每个worker都用新的输入队列. 被杀掉的进程可能一直占着原来队列的
+        # 锁, 原来的队列中剩下的样本由_requeue重新分配
+        old_queue = self.input_queues[worker_id]
+        if old_queue is not None and self.backend == "process":
+            old_queue.cancel_join_thread()
+            old_queue.close()
+        self.input_queues[worker_id] = self._new_input_queue()
+        self.status.end(worker_id)
+        self.status.ready[worker_id] = 0
+        worker_class = self.worker_classes[self.backend]
+        self.processes[worker_id] = worker_class(self.task_class,
+                                                 self.task_args[worker_id],
+                                                 self.input_queues[worker_id],
+                                                 self.output_queue,
+                                                 self.transport,
+                                                 worker_id,
+                                                 self.status)
+        self.processes[worker_id].start()
+
+    def _choose_worker(self, count):
+        """选择预计最早处理完已经分配的样本的worker.
+
+        按照每个worker的处理速度估计, 还没有速度的worker用其他worker的
+        平均速度. 这样处理得快的worker会分到更多的样本.
         """
 
-        if self.is_single_thread:
-            results = []
-            start_time = time.time()
-            for sid, sample in enumerate(samples, 1):
-                if isinstance(sample, tuple):
-                    results.append(self.task_instance.process(*sample))
-                else:
-                    results.append(self.task_instance.process(sample))
-                if time.time() - start_time > 5:
-                    logging.info("Progress (sequential) %d/%d",
-                                 sid,
-                                 len(samples))
-                    start_time = time.time()
-            return results
-
-        samples = list(enumerate(samples))
-        batch_size = batch_size or len(samples)
-        num_samples = len(samples)
-
-        # 装载首个batch
-        batch_samples = samples[:batch_size]
-        samples = samples[batch_size:]
-        for sample in batch_samples:
-            self.input_queue.put(sample)
-
-        results = []
-        start_time = time.time()
-        while len(results) < num_samples:
-            if self.input_queue.qsize() < batch_size and len(samples) != 0:
-                if self.input_queue.empty():
-                    # 这里提醒一下要提高batch_size
-                    logging.warning("input queue is empty, time wasted.")
-                batch_samples = samples[:batch_size]
-                samples = samples[batch_size:]
-                for sample in batch_samples:
-                    self.input_queue.put(sample)
-            while not self.output_queue.empty():
-                results.append(self.output_queue.get())
-            if len(results) < num_samples:
-                time.sleep(1)  # 这里sleep的时间不能过长
-            if time.time() - start_time > 5:
-                logging.info("Progress (threads %d) %d/%d",
-                             len(self.processes),
-                             len(results),
-                             num_samples)
-                start_time = time.time()
+        rates = []
+        for num_items, busy_time in zip(self.status.num_items,
+                                        self.status.busy_time):
+            rates.append(num_items / busy_time if busy_time > 0 else 0.0)
+        known = [rate for rate in rates if rate > 0]
+        default = sum(known) / len(known) if known else 1.0
+        return min(
+            range(len(rates)),
+            key=lambda i: (self.assigned[i] + count) / (rates[i] or default))
+
+    def _submit(self, sid, sample, num_retries=0):
+        count = len(sample) if isinstance(sample, _Chunk) else 1
+        worker_id = self._choose_worker(count)
+        self.pending[sid] = [sample, num_retries, worker_id]
+        self.num_pending_items += count
+        self.assigned[worker_id] += count
+        self.input_queues[worker_id].put((sid, sample))
+
+    def _pop(self, sid):
+        task = self.pending.pop(sid, None)
+        if task is None: return None
+        count = len(task[0]) if isinstance(task[0], _Chunk) else 1
+        self.num_pending_items -= count
+        self.assigned[task[2]] -= count
+        return task
+
+    def _fail(self, sid, reason, retry=True):
+        """sid对应的样本因为进程退出或者超时失败, 重试或者返回TaskFailure."""
+
+        task = self._pop(sid)
+        if task is None: return []
+        sample, num_retries, _ = task
+        if retry and isinstance(sample, _Chunk) and len(sample) > 1:
+            # chunk中其他的样本也没有结果, 拆开重新处理, 只让出错的样本失败
+            for index, item in enumerate(sample):
+                self._submit(sid + index, item, num_retries + 1)
+            return []
+        if retry and num_retries < self.max_retries:
+            self._submit(sid, sample, num_retries + 1)
+            return []
+        count = len(sample) if isinstance(sample, _Chunk) else 1
+        return [(sid + i, TaskFailure(sid + i, RuntimeError(reason)))
+                for i in range(count)]
+
+    def _requeue(self, worker_id, sid, reason, retry=True):
+        """把分配给退出或者超时的worker的样本重新分配给其他的worker.
+
+        只有正在处理的样本sid计入重试次数, 其他的样本还在输入队列中等待,
+        与worker的退出无关. worker在返回结果之后, 父进程取回之前退出时,
+        同一个样本的结果会返回两次, 重复的结果在_receive中被忽略.
+        """
+
+        failures = []
+        lost = [i for i, task in self.pending.items() if task[2] == worker_id]
+        for lost_sid in lost:
+            if lost_sid == sid:
+                failures += self._fail(sid, reason, retry)
+            else:
+                sample, num_retries, _ = self._pop(lost_sid)
+                self._submit(lost_sid, sample, num_retries)
+        return failures
+
+    def _count_init_failure(self, worker_id):
+        if self.status.ready[worker_id]:
+            self.init_failures[worker_id] = 0
+            return
+        self.init_failures[worker_id] += 1
+        if self.init_failures[worker_id] < self.max_init_failures: return
+        # 不停地重启也不会成功, 杀掉其他的worker, 以免程序退出时等待它们
+        for proc in self.processes:
+            if proc.is_alive(): proc.kill()
+        for proc in self.processes:
+            proc.join(self.check_interval)
+        raise RuntimeError(f"Worker {worker_id} failed to initialize "
+                           f"{self.init_failures[worker_id]} times.")
+
+    def _check_workers(self, retry=True):
+        """检查子进程是否退出或者超时, 返回重试次数用完的(sid, TaskFailure)."""
+
+        failures = []
+        for worker_id, proc in enumerate(self.processes):
+            sid = self.status.current[worker_id]
+            if proc.is_alive():
+                elapsed = time.time() - self.status.started[worker_id]
+                if self.timeout is None or sid < 0 or elapsed < self.timeout:
+                    continue
+                proc.kill()
+                # 线程不能被杀掉, 所以这里不能一直等待
+                proc.join(self.check_interval)
+                reason = f"timeout after {self.timeout}s"
+            else:
+                reason = f"worker exited with code {proc.exitcode}"
+                self._count_init_failure(worker_id)
+            logging.warning("Worker %d: %s, sample %d.", worker_id, reason, sid)
+            if self.transport is not None: self.transport.reclaim(worker_id)
+            self._start_worker(worker_id)
+            failures += self._requeue(worker_id, sid, reason, retry)
+        return failures
+
+    def _receive(self, tuner=None, retry=True):
+        """等待子进程返回的结果, 返回完成的[(sid, result), ...].
+
+        等待的同时会检查子进程的状态, 失败的样本重试时返回空的列表.
+        """
+
+        # 没有设置timeout时只需要等待结果或者子进程退出
+        wait_time = None if self.timeout is None else self.check_interval
+        next_check = time.time() + self.check_interval
+        while True:
+            if time.time() >= next_check:
+                failures = self._check_workers(retry)
+                if failures or not self.pending: return failures
+                next_check = time.time() + self.check_interval
+            sentinels = [proc.sentinel for proc in self.processes]
+            if not self.output_queue.wait(sentinels, wait_time):
+                next_check = 0
+                continue
+            sid, result = self.output_queue.get()
+            # 超时的样本被杀掉之前可能已经返回了结果, 这时忽略重复的结果
+            if self._pop(sid) is None: continue
+            if not isinstance(result, _Chunk): return [(sid, result)]
+            if tuner is not None: tuner.update(result)
+            return list(enumerate(result, sid))
+
+    def _imap(self,
+              samples,
+              batch_size,
+              chunksize,
+              progress,
+              checkpoint,
+              ordered):
+        # 返回(sid, result), ordered为False时按照完成的顺序
+        if isinstance(checkpoint, str):
+            with Checkpoint(checkpoint) as own_checkpoint:
+                yield from self._imap(samples,
+                                      batch_size,
+                                      chunksize,
+                                      progress,
+                                      own_checkpoint,
+                                      ordered)
+            return
+        try:
+            if self.is_single_thread:
+                yield from self._run_sequential(samples, progress, checkpoint)
+            else:
+                yield from self._run(samples,
+                                     batch_size,
+                                     chunksize,
+                                     progress,
+                                     checkpoint,
+                                     ordered)
+        finally:
+            if checkpoint is not None: checkpoint.flush()
+
+    def _run_sequential(self, samples, progress, checkpoint):
+        num_total = len(samples) if hasattr(samples, "__len__") else None
+        progress = progress or ProgressLogger("sequential")
+        for sid, sample in enumerate(samples):
+            if checkpoint is not None and sid in checkpoint:
+                result = checkpoint[sid]
+            elif not self.return_failures:
+                result = _process_sample(self.task_instance, sample)
+                if checkpoint is not None: checkpoint.add(sid, result)
+            else:
+                try:
+                    result = _process_sample(self.task_instance, sample)
+                except Exception as exc:  # pylint: disable=broad-except
+                    result = TaskFailure.from_exception(sid, exc)
+                    logging.warning("Sample %d failed: %r\n%s",
+                                    sid,
+                                    result.error,
+                                    result.traceback)
+                if checkpoint is not None and not isinstance(
+                        result, TaskFailure):
+                    checkpoint.add(sid, result)
+            progress(sid + 1, num_total)
+            yield sid, result
+
+    def _run(self,
+             samples,
+             batch_size,
+             chunksize,
+             progress,
+             checkpoint,
+             ordered):
+        num_total = len(samples) if hasattr(samples, "__len__") else None
+
+        progress = progress or ProgressLogger(f"threads {len(self.processes)}")
+        tuner = _ChunkTuner(chunksize, num_total, len(self.processes))
+        scheduler = _Scheduler(self.status, batch_size)
+        chunks = _iter_chunks(samples, tuner, checkpoint)
+        reorder = _ReorderBuffer(ordered)
+        num_done, exhausted = 0, False
+        try:
+            while True:
+                # 处理中和等待重排序的样本数不超过limit, 其余的样本留在
+                # 迭代器中. 等待重排序的结果之前的样本一定在处理中, 所以
+                # 这里不会死锁
+                while not exhausted and self.num_pending_items + len(
+                        reorder) < scheduler.limit(tuner.chunksize):
+                    restored, chunk = next(chunks, (None, None))
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    if restored:
+                        num_done += 1
+                        progress(num_done, num_total)
+                        yield from reorder.push([(chunk, checkpoint[chunk])])
+                        continue
+                    if len(chunk) == 1 and not tuner.auto:
+                        self._submit(*chunk[0])
+                    else:
+                        samples_chunk = _Chunk(sample for _, sample in chunk)
+                        self._submit(chunk[0][0], samples_chunk)
+                if not self.pending: break
+                results = self._receive(tuner)
+                if self.transport is not None:
+                    decode = self.transport.decode
+                    results = [(i, decode(r)) for i, r in results]
+                failure = None
+                for sid, result in results:
+                    if isinstance(result, TaskFailure):
+                        logging.warning("Sample %d failed: %r\n%s",
+                                        sid,
+                                        result.error,
+                                        result.traceback)
+                        failure = failure or result
+                    elif checkpoint is not None:
+                        checkpoint.add(sid, result)
+                if failure is not None and not self.return_failures:
+                    self._drain()
+                    raise failure.error
+                num_done += len(results)
+                if results: progress(num_done, num_total)
+                yield from reorder.push(results)
+        except GeneratorExit:
+            self._drain()
+            raise
+
+    def _drain(self):
+        # 调用者提前退出或者抛出异常时, 取回还在处理中的结果, 保证pool可以
+        # 继续使用. 丢弃的结果也要decode, 它们用到的共享内存块才会被放回
+        # 空闲队列
+        while self.pending:
+            results = self._receive(retry=False)
+            if self.transport is None: continue
+            for _, result in results:
+                self.transport.decode(result)
+
+    def imap(self,
+             samples,
+             batch_size=0,
+             chunksize=1,
+             progress=None,
+             checkpoint=None):
+        """多进程处理的生成器, 按照samples的顺序返回结果, 类似于pool.imap.
+
+        samples可以是任意的可迭代对象, 只有在需要的时候才会从中读取样本.
+        同时在处理中的样本数是有上限的(参考batch_size), 先完成的结果暂存在
+        重排序的缓冲区中, 也计入这个上限, 所以内存占用与样本总数无关. 每个worker有自己的
+        输入队列, 父进程按照处理速度分配样本, 处理得快的worker会分到更多
+        的样本, 一个worker被杀掉也不会影响其他worker的输入.
+
+        每个样本都要经过一次pickle和进程间通信, 处理单个样本很快的时候,
+        通信的开销会超过处理本身. 这时可以设置chunksize, 将连续的多个样本
+        打包在一起传递给子进程.
+
+        Args:
+            samples: 样本的可迭代对象.
+            batch_size: 同时在处理中(包括等待重排序)的最大样本数, 为0时
+                根据每个worker的处理速度自动调整, 参考_Scheduler.
+            chunksize: 每次传递给子进程的样本数, 为0时根据处理时间自动调整.
+            progress: 进度回调, 默认每5秒打印一次进度, 参考ProgressLogger.
+            checkpoint: 断点文件的路径或者Checkpoint. 完成的结果会定期保存
+                到断点文件中, 重新运行时跳过已经完成的样本, 直接返回保存的
+                结果, 这样中断之后的结果与没有中断时相同. 失败的样本不会
+                保存, 重新运行时会再次处理.
+        """
 
-        results.sort(key=lambda x: x[0])
-        results = list(list(zip(*results))[1])
-        return results
+        for _, result in self._imap(samples, batch_size, chunksize,
+                                    progress, checkpoint, True):
+            yield result
+
+    def imap_unordered(self,
+                       samples,
+                       batch_size=0,
+                       chunksize=1,
+                       progress=None,
+                       checkpoint=None):
+        """与imap相同, 但是按照完成的顺序返回结果."""
+
+        for _, result in self._imap(samples, batch_size, chunksize,
+                                    progress, checkpoint, False):
+            yield result
+
+    def process(self,
+                samples,
+                batch_size=0,
+                chunksize=1,
+                progress=None,
+                checkpoint=None):
+        """多进程批量处理函数, 类似于pool.map. 参数请参考imap."""
+
+        return list(
+            self.imap(samples, batch_size, chunksize, progress, checkpoint))
+
+    def stats(self):
+        """返回每个worker的统计, 每一项为一个dict:
+
+        items: 处理的样本数, items_per_second: 从pool创建开始平均每秒处理
+        的样本数, busy_time: 处理样本的时间, idle_time: 其余的时间,
+        queue_wait: 等待输入队列的时间(秒). 串行处理时返回空的列表.
+        """
+
+        if self.is_single_thread: return []
+        return self.status.stats()
 
     def finish(self):
         assert self.output_queue.empty(), \
             "Internal error: output queue must be empty."
 
+        if self.transport is not None: self.transport.close()
         if self.is_single_thread: return None
 
         # 传递None让子进程退出
-        for proc in self.processes:
-            self.input_queue.put((None, None))
-        while not self.input_queue.empty():
-            time.sleep(1)
+        for input_queue in self.input_queues:
+            input_queue.put((None, None))
 
-        # 必须保证子进程中的queue都为空, 否则会造成死锁
+        # 子进程的结果都已经取回, 所以这里join不会死锁
         for proc in self.processes:
             proc.join()
+        if self.event_loop is not None: self.event_loop.close()
         return None
 
     @staticmethod
-    def get_pool(numthreads, taskfun, args=tuple()):
+    def get_pool(numthreads, taskfun, args=tuple(), **kwargs):
         """函数版本的multiprocessing.Pool.
 
         taskfun (function): 只能为全局函数或者类中的staticmethod, 函数定义
             如下: taskfun(sample, args), 如果sample或者args为tuple, 则将其
             展开: taskfun(*sample, *args).
+        kwargs: 传给TaskPool的其他参数, 比如transport, timeout.
         """
-        return TaskPool(_ProxyTaskClass, [(taskfun, args)] * numthreads)
+        proxy_class = _ProxyTaskClass
+        if inspect.iscoroutinefunction(taskfun):
+            proxy_class = _AsyncProxyTaskClass
+        return TaskPool(proxy_class, [(taskfun, args)] * numthreads, **kwargs)
 
     @staticmethod
-    def map(numthreads, taskfun, samples, args=tuple(), batch_size=0):
-        """函数版本的map. 参数请参考get_pool."""
-
-        pool = TaskPool.get_pool(numthreads, taskfun, args)
-        results = pool.process(samples, batch_size)
-        pool.finish()
-        return results
+    def map(numthreads,
+            taskfun,
+            samples,
+            args=tuple(),
+            batch_size=0,
+            chunksize=1,
+            progress=None,
+            checkpoint=None,
+            **kwargs):
+        """函数版本的map. 参数请参考get_pool和imap."""
+
+        pool = TaskPool.get_pool(numthreads, taskfun, args, **kwargs)
+        # 样本失败抛出异常时也要让子进程退出
+        try:
+            return pool.process(samples,
+                                batch_size,
+                                chunksize,
+                                progress,
+                                checkpoint)
+        finally:
+            pool.finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import os
+import mmap
+import logging
+import numpy as np
+
+
+class SampleList:
+    """按需读取的样本列表, 用于代替read_list_file读取很大的列表文件.
+
+    文件通过mmap映射到内存, 并建立每一行起始位置的索引, 这样可以在O(1)
+    的时间内随机访问任意一行. 索引保存在<path>.idx中, 格式为uint64数组:
+    [文件大小, mtime_ns, 第0行的起始位置, ..., 文件结尾], 文件发生变化时
+    自动重建. 每一行返回时会去掉首尾的空白, 与read_list_file一致.
+
+    Args:
+        path: 列表文件.
+        cache: 是否将索引保存到磁盘上.
+    """
+
+    chunk_size = 64 << 20
+
+    def __init__(self, path, cache=True):
+        self.path = path
+        self.index_file = path + ".idx"
+        with open(path, "rb") as srcfile:
+            stat = os.fstat(srcfile.fileno())
+            self.header = [stat.st_size, stat.st_mtime_ns]
+            self.data = b""
+            if stat.st_size > 0:
+                self.data = mmap.mmap(
+                    srcfile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = self._load_index() if cache else None
+        if self.offsets is None:
+            self.offsets = self._build_index(cache)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file): return None
+        index = np.memmap(self.index_file, dtype=np.uint64, mode="r")
+        if len(index) < 3 or list(index[:2]) != self.header: return None
+        return index[2:]
+
+    def _iter_offsets(self):
+        # 每一行的起始位置, 最后再加上文件的结尾作为最后一行的结束位置
+        size = len(self.data)
+        yield np.zeros(1, dtype=np.uint64)
+        for start in range(0, size, self.chunk_size):
+            count = min(self.chunk_size, size - start)
+            chunk = np.frombuffer(self.data, np.uint8, count, start)
+            newlines = np.flatnonzero(chunk == ord("\n"))
+            newlines = newlines.astype(np.uint64) + np.uint64(start + 1)
+            # 最后一行没有换行符时, 需要补上文件结尾作为其结束位置
+            if 0 < size == start + count and chunk[-1] != ord("\n"):
+                newlines = np.append(newlines, np.uint64(size))
+            yield newlines
+
+    def _build_index(self, cache):
+        if cache:
+            temp_file = f"{self.index_file}.{os.getpid()}.tmp"
+            try:
+                with open(temp_file, "wb") as dstfile:
+                    np.array(self.header, dtype=np.uint64).tofile(dstfile)
+                    for offsets in self._iter_offsets():
+                        offsets.tofile(dstfile)
+                os.replace(temp_file, self.index_file)
+                return self._load_index()
+            except OSError:
+                logging.warning("Failed to write index: %s", self.index_file)
+                if os.path.exists(temp_file): os.remove(temp_file)
+        return np.concatenate(list(self._iter_offsets()))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SampleList index out of range")
+        start = int(self.offsets[index])
+        end = int(self.offsets[index + 1])
+        return self.data[start:end].decode("utf-8").strip()
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+if __name__ == "__main__":
+    pass
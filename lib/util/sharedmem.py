@@ -0,0 +1,164 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import queue
+import ctypes
+import logging
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class _SharedArray:
+    """共享内存中的数组的描述, 只有这个描述需要经过queue传递."""
+
+    __slots__ = ("name", "shape", "dtype")
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return self.name, self.shape, self.dtype
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype = state
+
+
+class _SharedBlock(shared_memory.SharedMemory):
+    """还有数组在使用时不能close, 这时留给进程退出时释放, 不再报错."""
+
+    def __del__(self):
+        try:
+            self.close()
+        except (OSError, BufferError):
+            pass
+
+
+class SharedArrayTransport:
+    """通过共享内存将子进程中的np.ndarray返回给父进程, 供TaskPool使用.
+
+    父进程预先创建num_blocks个大小为block_size的共享内存块, 空闲块的名字
+    放在free_queue中. 子进程返回结果时, 将其中足够大的数组拷贝到一个空闲
+    块中, 通过queue只传递块的名字, 形状和类型. 父进程直接在共享内存上
+    构造数组, 不再拷贝; 数组(包括它的所有视图)被释放之后, 块会自动放回
+    free_queue中重复使用.
+
+    结果可以是数组, 或者由tuple, list, dict嵌套的数组. 小于min_bytes或者
+    大于block_size的数组, 以及没有空闲块的时候, 仍然通过pickle传递.
+
+    owners(共享内存)纪录了每个块被哪个worker取走, 返回结果之前worker调用
+    sent()清除纪录, 之后块由父进程负责. worker在这之间退出时, 父进程用
+    reclaim()把它取走的块放回free_queue, 否则这些块会永远丢失.
+
+    Args:
+        block_size: 每个共享内存块的字节数.
+        num_blocks: 共享内存块的个数.
+        min_bytes: 小于这个字节数的数组直接pickle.
+    """
+
+    def __init__(self, block_size=16 << 20, num_blocks=8, min_bytes=64 << 10):
+        self.block_size = block_size
+        self.min_bytes = min_bytes
+        self.free_queue = multiprocessing.Queue()
+        # 父进程中创建的块
+        self.blocks = {}
+        for _ in range(num_blocks):
+            block = _SharedBlock(create=True, size=block_size)
+            self.blocks[block.name] = block
+            self.free_queue.put(block.name)
+        self.block_ids = {name: i for i, name in enumerate(self.blocks)}
+        self.owners = multiprocessing.RawArray("q", [-1] * num_blocks)
+        self.in_use = set()
+        self.closed = False
+        # 子进程中打开的块
+        self.attached = {}
+
+    def encode(self, value, worker_id=-1):
+        """在子进程中调用, 将value中的数组放到共享内存中."""
+
+        if isinstance(value, np.ndarray):
+            return self._encode_array(value, worker_id)
+        if isinstance(value, tuple):
+            return tuple(self.encode(item, worker_id) for item in value)
+        if isinstance(value, list):
+            return [self.encode(item, worker_id) for item in value]
+        if isinstance(value, dict):
+            return {
+                key: self.encode(item, worker_id) for key, item in value.items()
+            }
+        return value
+
+    def _encode_array(self, array, worker_id):
+        if (array.dtype.hasobject or array.nbytes < self.min_bytes or
+                array.nbytes > self.block_size):
+            return array
+        try:
+            name = self.free_queue.get_nowait()
+        except queue.Empty:
+            # 父进程还持有所有的块, 不能等待, 否则可能会死锁
+            return array
+        self.owners[self.block_ids[name]] = worker_id
+        if name not in self.attached:
+            self.attached[name] = _SharedBlock(name=name)
+        buffer = self.attached[name].buf
+        np.ndarray(array.shape, array.dtype, buffer)[...] = array
+        return _SharedArray(name, array.shape, array.dtype.str)
+
+    def sent(self, worker_id):
+        """在子进程中返回结果之前调用, 取走的块交给父进程负责."""
+
+        for index, owner in enumerate(self.owners):
+            if owner == worker_id: self.owners[index] = -1
+
+    def reclaim(self, worker_id):
+        """在父进程中调用, 找回已经退出的worker取走但没有返回的块."""
+
+        for name, index in self.block_ids.items():
+            if self.owners[index] != worker_id: continue
+            logging.warning("Reclaim shared block %s of worker %d.",
+                            name,
+                            worker_id)
+            self.owners[index] = -1
+            self.free_queue.put(name)
+
+    def decode(self, value):
+        """在父进程中调用, encode的逆过程."""
+
+        if isinstance(value, _SharedArray): return self._decode_array(value)
+        if isinstance(value, tuple):
+            return tuple(self.decode(item) for item in value)
+        if isinstance(value, list): return [self.decode(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self.decode(item) for key, item in value.items()}
+        return value
+
+    def _decode_array(self, desc):
+        dtype = np.dtype(desc.dtype)
+        nbytes = int(np.prod(desc.shape, dtype=np.int64)) * dtype.itemsize
+        # numpy会为memoryview再创建一个memoryview, 所以这里用ctypes的对象
+        # 作为数组的base, 数组和它的所有视图都被释放之后, 它才会被释放
+        block = self.blocks[desc.name]
+        buffer = (ctypes.c_char * nbytes).from_buffer(block.buf)
+        self.in_use.add(desc.name)
+        weakref.finalize(buffer, self._release, desc.name)
+        return np.frombuffer(buffer, dtype).reshape(desc.shape)
+
+    def _release(self, name):
+        self.in_use.discard(name)
+        if not self.closed: self.free_queue.put(name)
+
+    def close(self):
+        """删除所有的块. 还在使用中的块要等到数组被释放之后才会关闭."""
+
+        if self.closed: return
+        self.closed = True
+        for name, block in self.blocks.items():
+            block.unlink()
+            if name not in self.in_use: block.close()
+
+
+if __name__ == "__main__":
+    pass
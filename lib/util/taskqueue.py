@@ -0,0 +1,114 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import asyncio
+import threading
+import collections
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing.reduction import ForkingPickler
+
+
+class _ResultQueue:
+    """子进程返回结果用的管道, 代替multiprocessing.Queue.
+
+    multiprocessing.Queue的put是在后台线程中完成的, 子进程在put之后马上
+    崩溃时结果会丢失, 甚至会一直占着写的锁, 让其他的进程都无法返回结果.
+    这里的put是同步的, 返回时结果已经在管道中. 父进程可以用wait同时等待
+    结果和子进程的退出, 不需要轮询.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.lock = multiprocessing.Lock()
+
+    def put(self, obj):
+        data = ForkingPickler.dumps(obj)
+        with self.lock:
+            self.writer.send_bytes(data)
+
+    def get(self):
+        return ForkingPickler.loads(self.reader.recv_bytes())
+
+    def empty(self):
+        return not self.reader.poll()
+
+    def wait(self, sentinels, timeout=None):
+        """等待结果或者子进程退出, 有结果时返回True."""
+
+        ready = multiprocessing.connection.wait([self.reader, *sentinels],
+                                                timeout)
+        return self.reader in ready
+
+
+class _LocalResultQueue:
+    """线程和asyncio后端的结果队列, 结果不需要pickle.
+
+    接口与_ResultQueue相同, worker退出时调用interrupt()唤醒wait.
+    """
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.interrupted = False
+
+    def put(self, obj):
+        with self.cond:
+            self.items.append(obj)
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            return self.items.popleft()
+
+    def empty(self):
+        return not self.items
+
+    def interrupt(self):
+        with self.cond:
+            self.interrupted = True
+            self.cond.notify()
+
+    def wait(self, sentinels, timeout=None):
+        # worker退出时会调用interrupt, 不需要等待sentinels
+        del sentinels
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.interrupted, timeout)
+            self.interrupted = False
+            return bool(self.items)
+
+
+class _EventLoopThread:
+    """asyncio后端的事件循环, 在一个单独的线程中运行, 所有的worker共用."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class _AsyncInputQueue:
+    """asyncio后端的输入队列, 每个worker一个.
+
+    put在父进程的主线程中调用, get在事件循环中调用.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+if __name__ == "__main__":
+    pass
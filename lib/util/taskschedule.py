@@ -0,0 +1,189 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import time
+import multiprocessing
+
+
+class _Chunk(list):
+    """打包在一起传递的连续多个样本(或者结果), sid为第一个样本的sid.
+
+    elapsed为子进程处理这些样本所用的时间, 用于自动调整chunksize.
+    """
+
+    elapsed = 0.0
+
+
+class _ChunkTuner:
+    """chunksize为0时, 根据子进程处理每个样本的平均时间调整chunksize,
+    使每个chunk的处理时间约为target_time秒. 同时保证每个进程至少能分到
+    几个chunk, 以免负载不均衡.
+    """
+
+    target_time = 0.05
+    max_chunksize = 4096
+
+    def __init__(self, chunksize, num_total, num_workers):
+        self.auto = chunksize == 0
+        self.chunksize = chunksize or 1
+        self.item_time = None
+        if num_total is not None:
+            self.max_chunksize = max(
+                1, min(self.max_chunksize, num_total // (4 * num_workers)))
+
+    def update(self, chunk):
+        if not self.auto or not chunk: return
+        item_time = chunk.elapsed / len(chunk)
+        if self.item_time is not None:
+            item_time = 0.5 * (self.item_time + item_time)
+        self.item_time = item_time
+        chunksize = self.target_time / max(item_time, 1.0e-7)
+        self.chunksize = int(min(max(chunksize, 1), self.max_chunksize))
+
+
+def _iter_chunks(samples, tuner, checkpoint):
+    """将samples分成sid连续的chunk, 返回(False, [(sid, sample), ...]).
+
+    断点文件中已经完成的样本单独返回(True, sid), chunk在这些样本处断开.
+    """
+
+    chunk = []
+    for sid, sample in enumerate(samples):
+        if checkpoint is not None and sid in checkpoint:
+            if chunk: yield False, chunk
+            chunk = []
+            yield True, sid
+            continue
+        chunk.append((sid, sample))
+        if len(chunk) >= tuner.chunksize:
+            yield False, chunk
+            chunk = []
+    if chunk: yield False, chunk
+
+
+class _ReorderBuffer:
+    """按照sid的顺序返回结果, 先完成的结果暂存在这里.
+
+    ordered为False时按照完成的顺序直接返回.
+    """
+
+    def __init__(self, ordered):
+        self.ordered = ordered
+        self.results = {}
+        self.next_sid = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def push(self, results):
+        """加入完成的[(sid, result), ...], 返回可以按顺序返回的结果."""
+
+        if not self.ordered: return results
+        self.results.update(results)
+        ready = []
+        while self.next_sid in self.results:
+            ready.append((self.next_sid, self.results.pop(self.next_sid)))
+            self.next_sid += 1
+        return ready
+
+
+class _WorkerStatus:
+    """所有子进程的状态, 保存在共享内存中, 每个进程只写自己的一项.
+
+    current为正在处理的样本的sid(chunk为第一个样本的sid), 空闲时为-1;
+    started为开始处理当前样本的时间. ready表示worker已经初始化完成.
+    num_items, busy_time和wait_time为
+    累计处理的样本数, 处理样本的时间以及等待输入队列的时间, 用于统计
+    每个worker的吞吐量. 重新启动的worker继续累计原来的统计.
+    """
+
+    def __init__(self, num_workers):
+        self.current = multiprocessing.RawArray("q", [-1] * num_workers)
+        self.started = multiprocessing.RawArray("d", num_workers)
+        self.ready = multiprocessing.RawArray("b", num_workers)
+        self.num_items = multiprocessing.RawArray("q", num_workers)
+        self.busy_time = multiprocessing.RawArray("d", num_workers)
+        self.wait_time = multiprocessing.RawArray("d", num_workers)
+        self.start_time = time.time()
+
+    def begin(self, worker_id, sid, restart=False, waited=0.0):
+        self.started[worker_id] = time.time()
+        self.wait_time[worker_id] += waited
+        if not restart: self.current[worker_id] = sid
+
+    def processed(self, worker_id, count, elapsed):
+        self.num_items[worker_id] += count
+        self.busy_time[worker_id] += elapsed
+
+    def sending(self, worker_id):
+        # 正在写结果的时候不能杀掉进程, 否则管道中会留下不完整的数据
+        self.started[worker_id] = float("inf")
+
+    def end(self, worker_id):
+        self.current[worker_id] = -1
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        stats = []
+        for worker_id in range(len(self.current)):
+            num_items = self.num_items[worker_id]
+            busy_time = self.busy_time[worker_id]
+            stats.append({
+                "worker": worker_id,
+                "items": num_items,
+                "items_per_second": num_items / max(elapsed, 1.0e-9),
+                "busy_time": busy_time,
+                "idle_time": max(elapsed - busy_time, 0.0),
+                "queue_wait": self.wait_time[worker_id],
+            })
+        return stats
+
+
+class _Scheduler:
+    """决定同时在处理中(包括在输入队列中等待和等待重排序)的最大样本数.
+
+    batch_size不为0时固定为batch_size. 否则根据每个worker处理样本的速度,
+    让输入队列中的样本足够所有的worker处理horizon秒, 这样父进程来不及
+    补充的时候worker也不会空闲. 同时每个worker至少有2个chunk, 总数不超过
+    max_items个样本, 以免占用太多的内存. 发现worker在等待输入队列时,
+    加大horizon.
+    """
+
+    horizon = 0.5
+    max_horizon = 8.0
+    max_items = 1 << 16
+    update_interval = 0.5
+
+    def __init__(self, status, batch_size):
+        self.status = status
+        self.batch_size = batch_size
+        self.num_workers = len(status.current)
+        self.rate = 0.0
+        self.wait_time = sum(status.wait_time)
+        self.next_update = time.time() + self.update_interval
+
+    def _update(self):
+        rate = 0.0
+        for num_items, busy_time in zip(self.status.num_items,
+                                        self.status.busy_time):
+            if busy_time > 0: rate += num_items / busy_time
+        wait_time = sum(self.status.wait_time)
+        # 有了速度之后, worker还在等待输入说明队列中的样本不够
+        starved = wait_time - self.wait_time > 0.1 * self.update_interval
+        if self.rate > 0 and starved:
+            self.horizon = min(2 * self.horizon, self.max_horizon)
+        self.rate = rate
+        self.wait_time = wait_time
+
+    def limit(self, chunksize):
+        if self.batch_size: return self.batch_size
+        if time.time() >= self.next_update:
+            self._update()
+            self.next_update = time.time() + self.update_interval
+        min_items = 2 * self.num_workers * chunksize
+        max_items = max(self.max_items, min_items)
+        return int(min(max(self.rate * self.horizon, min_items), max_items))
+
+
+if __name__ == "__main__":
+    pass
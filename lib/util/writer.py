@@ -0,0 +1,84 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+import os
+import copy
+import atexit
+import logging
+import threading
+import collections
+
+from lib.util.common import read_json_file
+from lib.util.common import write_json_file
+
+
+class AsyncJsonWriter:
+    """在后台线程中写json文件.
+
+    write()只是把数据放入队列就返回, 同一个文件在写入之前的多次write()会被
+    合并, 只写最后一次的数据. 所有的文件都是先写临时文件再改名, 所以程序
+    崩溃也不会留下不完整的文件. 退出前需要调用close(), 保证队列中的数据
+    全部写入磁盘. 后台线程是daemon线程, 所以没有调用close()时, 解释器
+    退出时也会调用close().
+    """
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.writing = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending: break
+                self.writing = self.pending.popitem(last=False)
+            path, data = self.writing
+            try:
+                write_json_file(data, path, atomic=True)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to write: %s", path)
+            with self.cond:
+                self.writing = None
+                self.cond.notify_all()
+
+    def write(self, data, path):
+        # 调用者可能会继续修改data, 所以这里保存一份拷贝
+        data = copy.deepcopy(data)
+        with self.cond:
+            assert not self.closed, "Writer has been closed."
+            self.pending.pop(path, None)
+            self.pending[path] = data
+            self.cond.notify_all()
+
+    def read(self, path):
+        """读取json文件, 如果该文件还没有写入磁盘, 则返回队列中的数据."""
+
+        with self.cond:
+            if path in self.pending:
+                return copy.deepcopy(self.pending[path])
+            if self.writing is not None and self.writing[0] == path:
+                return copy.deepcopy(self.writing[1])
+        if not os.path.exists(path): return None
+        return read_json_file(path)
+
+    def flush(self):
+        with self.cond:
+            while self.pending or self.writing is not None:
+                self.cond.wait()
+
+    def close(self):
+        atexit.unregister(self.close)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+if __name__ == "__main__":
+    pass
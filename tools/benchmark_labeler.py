@@ -0,0 +1,345 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+"""不需要界面的标注工具性能测试.
+
+生成指定分辨率和标注密度的图像集, 用脚本化的按键/鼠标事件驱动Labeler,
+ScaleLabeler, PointLabeler和RegionLabeler. cv2.imshow和cv2.waitKey被替换
+为不显示窗口的版本, waitKey每次返回脚本中的下一个按键, 或者先调用鼠标
+回调函数再返回-1, 脚本结束时返回esc.
+
+每一组(标注类, 脚本)在单独的进程中运行, 输出每秒处理的事件数, 每个事件
+的延迟(事件处理加上下一帧的绘制), 其中翻页的延迟, 绘制一帧的耗时和内存
+峰值. 只有显示内容变化时才绘制, 所以不统计帧率. 各阶段的耗时来自标注类
+的profile_trace.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import cv2
+import numpy as np
+
+import init
+import lib.util
+import lib.labeler
+from point_labeler import PointLabeler
+from region_labeler import RegionLabeler
+
+SCRIPTS = ["navigate", "zoom", "hover", "drag", "edit"]
+
+LABELERS = {
+    "Labeler": lib.labeler.Labeler,
+    "ScaleLabeler": lib.labeler.ScaleLabeler,
+    "PointLabeler": PointLabeler,
+    "RegionLabeler": RegionLabeler
+}
+
+
+def generate_dataset(root, num_images, width, height, density, seed=0):
+    """生成图像, 样本列表以及矩形框和点两种标注, 每张图像density个标注."""
+
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, "images"), exist_ok=True)
+    boxes_store = lib.labeler.JsonFileStore(os.path.join(root, "boxes"))
+    points_store = lib.labeler.JsonFileStore(os.path.join(root, "points"))
+    names = [f"{n:06d}" for n in range(num_images)]
+    for name in names:
+        # 平滑过的噪声, 解码的代价与真实图像接近
+        image = rng.randint(0, 256, (height // 8, width // 8, 3))
+        image = cv2.resize(image.astype(np.uint8), (width, height))
+        cv2.imwrite(os.path.join(root, "images", name + ".jpg"), image)
+        x1 = rng.randint(0, width - 1, density)
+        y1 = rng.randint(0, height - 1, density)
+        x2 = np.minimum(x1 + rng.randint(20, 200, density), width - 1)
+        y2 = np.minimum(y1 + rng.randint(20, 200, density), height - 1)
+        boxes_store.save(name, np.stack([x1, y1, x2, y2], axis=1).tolist())
+        points_store.save(name, np.stack([x1, y1], axis=1).tolist())
+    lib.util.write_list_file(names, os.path.join(root, "samples.txt"))
+
+
+def make_script(name, num_images, width, height, seed=0):
+    """生成事件脚本, 每一项为("key", key)或者("mouse", event, x, y, flags).
+
+    坐标相对于显示窗口, width和height为显示窗口的大小.
+    """
+
+    rng = np.random.RandomState(seed)
+    script = []
+    if name == "navigate":
+        script += [("key", ord("f"))] * (num_images - 1)
+        script += [("key", ord("b"))] * (num_images - 1)
+    elif name == "zoom":
+        for flags in [-1] * 40 + [1] * 40:
+            script.append(("mouse", cv2.EVENT_MOUSEWHEEL, 0, 0, flags))
+        script.append(("key", ord("a")))
+    elif name == "hover":
+        for n in range(400):
+            x = int(n * (width - 1) / 399)
+            y = int(n * (height - 1) / 399)
+            script.append(("mouse", cv2.EVENT_MOUSEMOVE, x, y, 0))
+    elif name == "drag":
+        for _ in range(20):
+            x, y = rng.randint(0, width // 2), rng.randint(0, height // 2)
+            script.append(("mouse", cv2.EVENT_LBUTTONDOWN, x, y, 0))
+            for step in range(1, 11):
+                script.append(("mouse",
+                               cv2.EVENT_MOUSEMOVE,
+                               x + step * width // 40,
+                               y + step * height // 40,
+                               cv2.EVENT_FLAG_LBUTTON))
+            script.append(("mouse",
+                           cv2.EVENT_LBUTTONUP,
+                           x + width // 4,
+                           y + height // 4,
+                           0))
+            script.append(("key", ord("a")))
+    elif name == "edit":
+        # 单击添加点, RegionLabeler中两次单击添加一个矩形
+        for _ in range(100):
+            x, y = rng.randint(0, width), rng.randint(0, height)
+            script.append(("mouse", cv2.EVENT_LBUTTONDOWN, x, y, 0))
+            script.append(("mouse", cv2.EVENT_LBUTTONUP, x, y, 0))
+            script.append(("mouse", cv2.EVENT_MOUSEMOVE, x, y, 0))
+    else:
+        raise ValueError(f"Unknown script: {name}")
+    return script
+
+
+class HeadlessDisplay:
+    """替换cv2中与窗口相关的函数, 由事件脚本代替键盘和鼠标."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.position = 0
+        self.callback = None
+        self.num_frames = 0
+        self.saved = {}
+
+    def __enter__(self):
+        for name in ["namedWindow", "setMouseCallback", "imshow", "waitKey"]:
+            self.saved[name] = getattr(cv2, name)
+            setattr(cv2, name, getattr(self, name))
+        return self
+
+    def __exit__(self, *args):
+        for name, fun in self.saved.items():
+            setattr(cv2, name, fun)
+
+    def namedWindow(self, name, *args):
+        pass
+
+    def setMouseCallback(self, name, callback, param=None):
+        del name
+        self.callback = callback, param
+
+    def imshow(self, name, image):
+        del name, image
+        self.num_frames += 1
+
+    def waitKey(self, delay=0):
+        del delay
+        if self.position >= len(self.script): return 27
+        event = self.script[self.position]
+        self.position += 1
+        if event[0] == "key": return event[1]
+        callback, param = self.callback
+        callback(*event[1:], param)
+        return -1
+
+
+def _event_latencies(records, span=None):
+    """返回每个事件的延迟: 事件所在帧的鼠标/按键处理加上下一帧的绘制.
+
+    waitKey每次处理脚本中的一个事件, 所以每个事件对应trace中的一帧, 没有
+    改变显示内容的事件的绘制耗时为0. 最后一个事件之后按esc退出, 那一帧
+    不在trace中, 所以不统计. span不为None时只统计包含这个span的帧, 比如
+    "move"为翻页.
+    """
+
+    latencies = []
+    for record, next_record in zip(records, records[1:]):
+        spans = record["spans"]
+        if "mouse" not in spans and "key" not in spans: continue
+        if span is not None and span not in spans: continue
+        render = next_record["spans"].get("render", 0.0)
+        latencies.append(
+            spans.get("mouse", 0.0) + spans.get("key", 0.0) + render)
+    return latencies
+
+
+def _percentiles(values):
+    if not values: return None
+    p50, p95 = np.percentile(values, [50, 95]).tolist()
+    return {"p50": round(p50, 3), "p95": round(p95, 3)}
+
+
+def run_benchmark(labeler_name, script_name, args):
+    """在子进程中运行一组测试, 返回测试结果."""
+
+    # 每次按键都会输出日志, 这里不需要
+    logging.getLogger().setLevel(logging.WARNING)
+    run_dir = tempfile.mkdtemp(dir=args.root)
+    ann_src = "points" if labeler_name == "PointLabeler" else "boxes"
+    shutil.copytree(
+        os.path.join(args.root, ann_src), os.path.join(run_dir, "annotations"))
+    trace_file = os.path.join(run_dir, "trace.jsonl")
+    params = {
+        "img_dir": os.path.join(args.root, "images"),
+        "ann_dir": os.path.join(run_dir, "annotations"),
+        "snapshot": os.path.join(run_dir, "snapshot.json"),
+        "samples": os.path.join(args.root, "samples.txt"),
+        "profile_trace": trace_file,
+        "async_save": args.async_save
+    }
+    if args.prefetch > 0: params["prefetch"] = (args.prefetch, 1)
+
+    labeler_class = LABELERS[labeler_name]
+    if labeler_class is lib.labeler.Labeler:
+        labeler = labeler_class(params)
+        scale = 1.0
+    else:
+        labeler = labeler_class(params, scale=args.scale)
+        scale = args.scale
+    width = int(round(args.width * scale))
+    height = int(round(args.height * scale))
+    script = make_script(script_name, args.num_images, width, height)
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with HeadlessDisplay(script) as display:
+        start = time.perf_counter()
+        labeler.run()
+        elapsed = time.perf_counter() - start
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # profiler只保留最近的若干帧, 所以这里从trace中读取所有的帧
+    with open(trace_file, encoding="utf-8") as srcfile:
+        records = [json.loads(line) for line in srcfile]
+    renders = [r["spans"]["render"] for r in records if "render" in r["spans"]]
+    result = {
+        "labeler": labeler_name,
+        "script": script_name,
+        "events": len(script),
+        "frames": display.num_frames,
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(len(script) / elapsed, 1),
+        "event_ms": _percentiles(_event_latencies(records)),
+        "render_ms": _percentiles(renders),
+        "navigation_ms": _percentiles(_event_latencies(records, "move")),
+        "rss_peak_mb": round(rss_peak / 1024, 1),
+        "rss_growth_mb": round((rss_peak - rss_start) / 1024, 1)
+    }
+    shutil.rmtree(run_dir)
+    return result
+
+
+def _format_percentiles(values):
+    if values is None: return "-"
+    return f"{values['p50']:.2f}/{values['p95']:.2f}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--root",
+        type=str,
+        default="",
+        help="working directory, a temporary one by default.")
+    parser.add_argument(
+        "--num_images",
+        type=int,
+        default=20,
+        help="number of generated images.")
+    parser.add_argument(
+        "--width", type=int, default=1920, help="width of generated images.")
+    parser.add_argument(
+        "--height", type=int, default=1080, help="height of generated images.")
+    parser.add_argument(
+        "--density",
+        type=int,
+        default=100,
+        help="number of annotations per image.")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=0.5,
+        help="initial scale of the scale labelers.")
+    parser.add_argument(
+        "--labelers",
+        type=str,
+        nargs="+",
+        default=list(LABELERS.keys()),
+        choices=list(LABELERS.keys()),
+        help="labelers to benchmark.")
+    parser.add_argument(
+        "--scripts",
+        type=str,
+        nargs="+",
+        default=SCRIPTS,
+        choices=SCRIPTS,
+        help="event scripts to run.")
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="number of samples to prefetch ahead.")
+    parser.add_argument(
+        "--async_save",
+        action="store_true",
+        help="save annotations in a background thread.")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="write results to this json file.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    lib.util.print_all_arguments(args)
+    temp_root = None
+    if not args.root:
+        args.root = temp_root = tempfile.mkdtemp()
+    generate_dataset(args.root,
+                     args.num_images,
+                     args.width,
+                     args.height,
+                     args.density)
+
+    results = []
+    for labeler_name in args.labelers:
+        for script_name in args.scripts:
+            # 每一组都用新的进程, 内存峰值互不影响
+            with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+                result = pool.apply(run_benchmark,
+                                    (labeler_name, script_name, args))
+            results.append(result)
+            logging.info(
+                "%-13s %-8s events/s: %8.1f, event(ms): %s, frames: %4d, "
+                "render(ms): %s, navigation(ms): %s, rss: %.1fMB",
+                labeler_name,
+                script_name,
+                result["events_per_second"],
+                _format_percentiles(result["event_ms"]),
+                result["frames"],
+                _format_percentiles(result["render_ms"]),
+                _format_percentiles(result["navigation_ms"]),
+                result["rss_peak_mb"])
+
+    if args.output:
+        report = {"args": vars(args), "results": results}
+        lib.util.write_json_file(report, args.output)
+    if temp_root is not None: shutil.rmtree(temp_root)
+
+
+if __name__ == "__main__":
+    lib.util.initialize_logger()
+    main()
+    print("Done!")
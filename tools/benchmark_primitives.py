@@ -0,0 +1,311 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+"""lib.util和lib.labeler中基础函数的性能测试.
+
+每一项测试用timeit计时: 先用autorange确定每轮的调用次数(每轮至少0.2秒),
+再重复repeat轮, 纪录每次调用的最小和中位耗时. 结果可以保存为json, 用
+--compare和之前保存的结果比较, 输出每一项的耗时比例.
+"""
+
+import os
+import sys
+import time
+import shutil
+import timeit
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+
+import init
+import lib.util
+import lib.labeler
+
+# 所有的测试, 每一项为(名字, 准备函数). 准备函数返回(被计时的函数, 每次
+# 调用处理的样本数), 样本数为None表示不计算吞吐量.
+BENCHMARKS = []
+
+
+def benchmark(name):
+
+    def register(setup_fun):
+        BENCHMARKS.append((name, setup_fun))
+        return setup_fun
+
+    return register
+
+
+def _square(x):
+    return x * x
+
+
+@benchmark("BoundingBox.properties")
+def bench_bbox_properties(args):
+    del args
+    bbox = lib.labeler.BoundingBox(30, 40, 10, 20)
+    return lambda: (bbox.width, bbox.height, bbox.area, bbox.center), None
+
+
+@benchmark("BoundingBox.iou")
+def bench_bbox_iou(args):
+    del args
+    bbox1 = lib.labeler.BoundingBox(10, 20, 110, 220)
+    bbox2 = lib.labeler.BoundingBox(50, 60, 150, 260)
+    return lambda: bbox1.iou(bbox2), None
+
+
+@benchmark("BoxSet.iou[n=10000]")
+def bench_boxset_iou(args):
+    del args
+    boxes = lib.labeler.BoxSet(_random_boxes(10000))
+    bbox = lib.labeler.BoundingBox(50, 60, 150, 260)
+    return lambda: boxes.iou([bbox]), 10000
+
+
+@benchmark("Line.cross_point")
+def bench_line_cross_point(args):
+    del args
+    line1 = lib.labeler.Line.create_from_points(0, 0, 100, 50)
+    line2 = lib.labeler.Line.create_from_points(0, 80, 100, 10)
+    return lambda: line1.get_cross_point(line2), None
+
+
+@benchmark("LineArray.cross_points[n=10000]")
+def bench_line_array_cross_points(args):
+    del args
+    boxes = _random_boxes(10000)
+    lines = lib.labeler.LineArray.create_from_points(*boxes.T)
+    line = lib.labeler.Line.create_from_points(0, 80, 100, 10)
+    return lambda: lines.get_cross_points(line), 10000
+
+
+@benchmark("draw_textlines")
+def bench_draw_textlines(args):
+    del args
+    image = np.zeros((540, 960, 3), dtype=np.uint8)
+    lines = ["Progress: 123/4567", "render: p50 1.2ms p95 3.4ms"]
+    return lambda: lib.util.draw_textlines(image, (20, 20), lines,
+                                           (0, 0, 255)), None
+
+
+@benchmark("draw_rectangles[n=10000]")
+def bench_draw_rectangles(args):
+    del args
+    image = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    boxes = _random_boxes(10000)
+    return lambda: lib.util.draw_rectangles(image, boxes, (0, 0, 255)), 10000
+
+
+@benchmark("stitch_images[9]")
+def bench_stitch_images(args):
+    del args
+    rng = np.random.RandomState(0)
+    images = [
+        rng.randint(0, 256, (480, 640, 3)).astype(np.uint8) for _ in range(9)
+    ]
+    return lambda: lib.util.stitch_images(images), 9
+
+
+@benchmark("get_label_color_map[255]")
+def bench_get_label_color_map(args):
+    del args
+    labels = [f"label_{n}" for n in range(255)]
+    return lambda: lib.util.get_label_color_map(labels), 255
+
+
+@benchmark("COLOR")
+def bench_color(args):
+    del args
+    return lambda: lib.util.COLOR("text", "bright red"), None
+
+
+@benchmark("write_json_file[n=10000]")
+def bench_write_json(args):
+    path = os.path.join(args.work_dir, "write.json")
+    data = _random_boxes(10000).tolist()
+    return lambda: lib.util.write_json_file(data, path), 10000
+
+
+@benchmark("read_json_file[n=10000]")
+def bench_read_json(args):
+    path = os.path.join(args.work_dir, "read.json")
+    lib.util.write_json_file(_random_boxes(10000).tolist(), path)
+    return lambda: lib.util.read_json_file(path), 10000
+
+
+@benchmark("write_pickle_file[n=10000]")
+def bench_write_pickle(args):
+    path = os.path.join(args.work_dir, "write.pkl")
+    data = _random_boxes(10000).tolist()
+    return lambda: lib.util.write_pickle_file(data, path), 10000
+
+
+@benchmark("read_pickle_file[n=10000]")
+def bench_read_pickle(args):
+    path = os.path.join(args.work_dir, "read.pkl")
+    lib.util.write_pickle_file(_random_boxes(10000).tolist(), path)
+    return lambda: lib.util.read_pickle_file(path), 10000
+
+
+@benchmark("write_list_file[n=10000]")
+def bench_write_list(args):
+    path = os.path.join(args.work_dir, "write.txt")
+    data = [[f"{n:08d}", str(n)] for n in range(10000)]
+    return lambda: lib.util.write_list_file(data, path), 10000
+
+
+@benchmark("read_list_file[n=10000]")
+def bench_read_list(args):
+    path = os.path.join(args.work_dir, "read.txt")
+    lib.util.write_list_file([f"{n:08d} {n}" for n in range(10000)], path)
+    return lambda: lib.util.read_list_file(path, " "), 10000
+
+
+@benchmark("read_map_file[n=10000]")
+def bench_read_map(args):
+    path = os.path.join(args.work_dir, "map.txt")
+    lib.util.write_list_file([f"{n:08d} {n}" for n in range(10000)], path)
+    return lambda: lib.util.read_map_file(path), 10000
+
+
+def _taskpool_benchmark(num_samples, chunksize):
+
+    def setup(args):
+        samples = list(range(num_samples))
+        return lambda: lib.util.TaskPool.map(args.num_threads,
+                                             _square,
+                                             samples,
+                                             chunksize=chunksize), num_samples
+
+    return setup
+
+
+def _register_taskpool_benchmarks(sizes):
+    for num_samples in sizes:
+        for chunksize, label in [(1, "1"), (0, "auto")]:
+            name = f"TaskPool.map[n={num_samples},chunksize={label}]"
+            benchmark(name)(_taskpool_benchmark(num_samples, chunksize))
+
+
+def _random_boxes(num_boxes, seed=0):
+    rng = np.random.RandomState(seed)
+    x1 = rng.randint(0, 1800, num_boxes)
+    y1 = rng.randint(0, 960, num_boxes)
+    x2 = x1 + rng.randint(10, 120, num_boxes)
+    y2 = y1 + rng.randint(10, 120, num_boxes)
+    return np.stack([x1, y1, x2, y2], axis=1)
+
+
+def run_benchmark(setup_fun, args):
+    fun, num_items = setup_fun(args)
+    timer = timeit.Timer(fun)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(args.repeat, number)]
+    result = {
+        "number": number,
+        "repeat": args.repeat,
+        "best_us": round(min(times) * 1e6, 3),
+        "median_us": round(float(np.median(times)) * 1e6, 3)
+    }
+    if num_items is not None:
+        result["items"] = num_items
+        result["items_per_second"] = round(num_items / min(times), 1)
+    return result
+
+
+def _get_meta():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=os.path.dirname(__file__),
+                                         stderr=subprocess.DEVNULL)
+        commit = commit.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "num_cpus": os.cpu_count()
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--filter",
+        type=str,
+        nargs="*",
+        default=[],
+        help="only run benchmarks containing these strings.")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of timing rounds of each benchmark.")
+    parser.add_argument(
+        "--taskpool_sizes",
+        type=int,
+        nargs="*",
+        default=[1000, 10000],
+        help="numbers of samples for TaskPool.map.")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="write timings to this json file for later --compare.")
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default="",
+        help="json file of a previous run to compare with.")
+    lib.util.add_common_argument(parser, {"num_threads": 4})
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    lib.util.print_all_arguments(args)
+    _register_taskpool_benchmarks(args.taskpool_sizes)
+    baseline = {}
+    if args.compare:
+        baseline = lib.util.read_json_file(args.compare)["results"]
+
+    args.work_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, setup_fun in BENCHMARKS:
+            if args.filter and not any(key in name for key in args.filter):
+                continue
+            try:
+                result = run_benchmark(setup_fun, args)
+            except OSError as error:
+                # 比如缺少字体文件, 纪录下来继续测试其他项
+                logging.warning("%s failed: %r", name, error)
+                results[name] = {"error": repr(error)}
+                continue
+            results[name] = result
+            line = (f"{name:<40} best: {result['best_us']:>12.2f}us, "
+                    f"median: {result['median_us']:>12.2f}us")
+            if "best_us" in baseline.get(name, {}):
+                ratio = result["best_us"] / baseline[name]["best_us"]
+                line += f", {ratio:.2f}x of baseline"
+            logging.info(line)
+    finally:
+        shutil.rmtree(args.work_dir)
+
+    if args.output:
+        report = {"meta": _get_meta(), "results": results}
+        lib.util.write_json_file(report, args.output)
+
+
+if __name__ == "__main__":
+    lib.util.initialize_logger()
+    main()
+    print("Done!")
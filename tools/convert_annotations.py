@@ -0,0 +1,61 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+"""在不同的标注存储方式之间转换.
+
+例如将每个样本一个json文件的标注转换为一个SQLite数据库:
+python convert_annotations.py --src ../data/annotations --src_backend json \
+    --dst ../data/annotations.db --dst_backend sqlite
+"""
+
+import argparse
+
+import init
+import lib.util
+import lib.labeler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--src",
+        type=str,
+        required=True,
+        help="source annotation directory or database.")
+    parser.add_argument(
+        "--src_backend",
+        type=str,
+        default="json",
+        choices=["json", "sqlite"],
+        help="backend of source annotations.")
+    parser.add_argument(
+        "--dst",
+        type=str,
+        required=True,
+        help="destination annotation directory or database.")
+    parser.add_argument(
+        "--dst_backend",
+        type=str,
+        default="sqlite",
+        choices=["json", "sqlite"],
+        help="backend of destination annotations.")
+    lib.util.add_common_argument(parser, {"sample_file": ""})
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    lib.util.print_all_arguments(args)
+    src = lib.labeler.create_annotation_store(args.src_backend, args.src)
+    dst = lib.labeler.create_annotation_store(args.dst_backend, args.dst)
+    # 不指定样本列表时转换所有的标注
+    names = lib.util.read_list_file(args.sample_file)
+    lib.labeler.convert_annotations(src, dst, names)
+    src.close()
+    dst.close()
+
+
+if __name__ == "__main__":
+    lib.util.initialize_logger()
+    main()
+    print("Done!")
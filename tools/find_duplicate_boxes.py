@@ -0,0 +1,72 @@
+#! /home/chenli/Documents/tools/anaconda3/envs/pytorch/bin/python
+# coding: utf-8
+
+"""检查标注目录中重复或者近似重复的矩形框.
+
+标注文件的格式与RegionLabeler保存的一致: [[x1, y1, x2, y2], ...].
+输出文件中每一行为: <样本名> <重复的组>, 每一组为逗号分隔的矩形下标.
+"""
+
+import argparse
+import logging
+
+import init
+import lib.util
+import lib.labeler
+
+
+def find_duplicates(name, ann_dir, threshold):
+    annotations = lib.labeler.JsonFileStore(ann_dir).load(name) or []
+    # 跳过不是矩形框的标注, 比如点标注
+    if not all(len(ann) == 4 for ann in annotations): return name, None
+    return name, lib.labeler.find_duplicate_boxes(annotations, threshold)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--ann_dir",
+        type=str,
+        required=True,
+        help="directory of annotation files.")
+    parser.add_argument(
+        "--iou_threshold",
+        type=float,
+        default=0.9,
+        help="boxes with iou above this are duplicates.")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="duplicates.txt",
+        help="path of the report file.")
+    lib.util.add_common_argument(parser, {"num_threads": 8})
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    lib.util.print_all_arguments(args)
+    names = lib.labeler.JsonFileStore(args.ann_dir).names()
+    task_args = (args.ann_dir, args.iou_threshold)
+    results = lib.util.TaskPool.map(
+        args.num_threads, find_duplicates, names, task_args, batch_size=1024)
+
+    lines, num_skipped = [], 0
+    for name, groups in results:
+        if groups is None:
+            num_skipped += 1
+            continue
+        if not groups: continue
+        groups = [",".join(str(i) for i in group) for group in groups]
+        lines.append([name] + groups)
+    lib.util.write_list_file(lines, args.output)
+    logging.info("%d of %d samples have duplicate boxes, %d skipped.",
+                 len(lines),
+                 len(names),
+                 num_skipped)
+
+
+if __name__ == "__main__":
+    lib.util.initialize_logger()
+    main()
+    print("Done!")
@@ -1,9 +1,22 @@
+import os
+import json
 import math
+import asyncio
+import time
+import shutil
+import signal
+import tempfile
 import unittest
+import cv2
+import numpy as np
 
 import init
 import lib.util
 import lib.labeler
+from region_labeler import RegionLabeler
+
+# 测试中需要检查Labeler和TaskPool的内部状态
+# pylint: disable=protected-access
 
 
 class TestLine(unittest.TestCase):
@@ -51,5 +64,713 @@ class TestLine(unittest.TestCase):
         self.assertTrue(line.below_to(x1, y1 + 1))
 
 
+class TestLineArray(unittest.TestCase):
+
+    def test_line_array(self):
+        points = [(0, 0, 1, 1), (1, 0, 0, 1), (0, 2, 5, 2), (3, 0, 3, 4),
+                  (2, 1, 7, 4)]
+        lines = [lib.labeler.Line.create_from_points(*p) for p in points]
+        array = lib.labeler.LineArray.create_from_points(*zip(*points))
+        self.assertEqual(len(array), len(lines))
+        self.assertEqual(array[4].to_list(), lines[4].to_list())
+
+        # 与Line逐条比较, 与坐标轴平行的直线判断结果为False
+        xs, ys = [-1, 0, 2, 3, 6], [-2, 0, 1, 2, 5]
+        distances = array.get_distances(xs, ys)
+        angles = array.get_slant_angles()
+        for i, line in enumerate(lines):
+            self.assertAlmostEqual(angles[i], line.get_slant_angle())
+            for j, (x, y) in enumerate(zip(xs, ys)):
+                self.assertAlmostEqual(distances[i, j], line.get_distance(x, y))
+                for name in ["left_to", "right_to", "above_to", "below_to"]:
+                    self.assertEqual(
+                        getattr(array, name)(xs, ys)[i, j],
+                        getattr(line, name)(x, y))
+
+        # 平行时交点为nan, 退化的直线所有判断为False
+        xs, ys = array.get_cross_points(lines[0])
+        self.assertTrue(math.isnan(xs[0]))
+        self.assertAlmostEqual(xs[1], 0.5)
+        degenerate = lib.labeler.LineArray([[0, 0, 1]])
+        self.assertTrue(degenerate.degenerate()[0])
+        self.assertFalse(degenerate.left_to(0, 0)[0])
+        self.assertTrue(math.isnan(degenerate.get_distances(0, 0)[0]))
+
+
+class TestBoxSet(unittest.TestCase):
+
+    def test_box_set(self):
+        boxes = [(0, 0, 9, 9), (20, 5, 5, 20), (3, 3, 6, 6)]
+        bboxes = [lib.labeler.BoundingBox(*box) for box in boxes]
+        box_set = lib.labeler.BoxSet(boxes)
+        self.assertEqual(len(box_set), 3)
+        self.assertEqual(box_set.to_list(), [list(b.bbox) for b in bboxes])
+        self.assertEqual(box_set.area.tolist(), [b.area for b in bboxes])
+        self.assertEqual(
+            box_set.contains(point=(5, 10)).tolist(),
+            [b.contains(point=(5, 10)) for b in bboxes])
+        for i, bbox1 in enumerate(bboxes):
+            for j, bbox2 in enumerate(bboxes):
+                self.assertAlmostEqual(
+                    box_set.iou(box_set)[i, j], bbox1.iou(bbox2))
+            self.assertEqual(
+                box_set.intersect(bbox1).tolist()[1],
+                list(bboxes[1].intersect(bbox1).bbox))
+
+        # 视图直接读写BoxSet中的数据, 删除其他矩形之后依然有效
+        view = box_set[2]
+        box_set.remove(box_set[0])
+        self.assertEqual(view, box_set[1])
+        self.assertEqual(view.bbox, (3, 3, 6, 6))
+        view.translate(1, 2)
+        self.assertEqual(box_set.to_list()[1], [4, 5, 7, 8])
+        view = box_set.append(lib.labeler.BoundingBox(1, 1, 2, 2))
+        self.assertEqual(box_set.get(view.box_id).area, 4)
+
+        box_set.increase(2)
+        self.assertEqual(box_set.to_list()[0], [10, 10, 40, 40])
+
+    def test_float_coords(self):
+        # 浮点数坐标不会被截断, 与BoundingBox一致
+        boxes = [(0.5, 0.5, 9.5, 9.5), (2.25, 3.0, 8.0, 9.75)]
+        bboxes = [lib.labeler.BoundingBox(*box) for box in boxes]
+        box_set = lib.labeler.BoxSet(boxes)
+        self.assertEqual(box_set.to_list(), [list(box) for box in boxes])
+        self.assertEqual(box_set[1].x1, 2.25)
+        self.assertAlmostEqual(
+            lib.labeler.box_iou_matrix(boxes, boxes)[0, 1],
+            bboxes[0].iou(bboxes[1]))
+        box_set = lib.labeler.BoxSet([(1, 2, 3, 4)])
+        box_set[0].x1 = 0.5
+        self.assertEqual(box_set.to_list(), [[0.5, 2, 3, 4]])
+        point_set = lib.labeler.PointSet([(1.5, 2.5)])
+        point_set.append((3, 4))
+        self.assertEqual(list(point_set), [(1.5, 2.5), (3.0, 4.0)])
+
+    def test_point_set(self):
+        point_set = lib.labeler.PointSet([[1, 2], [5, 5], [1, 2]])
+        self.assertEqual(list(point_set), [(1, 2), (5, 5), (1, 2)])
+        self.assertEqual(point_set.nearest(4, 4), ((5, 5), 2))
+        point_set.remove((1, 2))
+        self.assertEqual(point_set.to_list(), [[5, 5], [1, 2]])
+        bbox = lib.labeler.BoundingBox(0, 0, 3, 3)
+        self.assertEqual(point_set.inside(bbox).tolist(), [False, True])
+        self.assertRaises(ValueError, point_set.remove, (7, 7))
+
+
+class TestBoxOps(unittest.TestCase):
+
+    def test_box_ops(self):
+        boxes = [(0, 0, 9, 9), (0, 0, 9, 10), (30, 30, 20, 20), (5, 5, 7, 7)]
+        bboxes = [lib.labeler.BoundingBox(*box) for box in boxes]
+        ious = lib.labeler.box_iou_matrix(boxes, bboxes[:2])
+        self.assertEqual(ious.shape, (4, 2))
+        for i, bbox1 in enumerate(bboxes):
+            for j, bbox2 in enumerate(bboxes[:2]):
+                self.assertAlmostEqual(ious[i, j], bbox1.iou(bbox2))
+        self.assertEqual(ious[2, 0], 0.0)
+
+        self.assertEqual(lib.labeler.box_nms(boxes, threshold=0.5), [0, 2, 3])
+        scores = [0.1, 0.9, 0.5, 0.2]
+        self.assertEqual(lib.labeler.box_nms(boxes, scores, 0.5), [1, 2, 3])
+        self.assertEqual(lib.labeler.find_duplicate_boxes(boxes, 0.8), [[0, 1]])
+        self.assertEqual(lib.labeler.find_duplicate_boxes(boxes, 0.95), [])
+
+
+class TestSamplePrefetcher(unittest.TestCase):
+
+    def test_prefetch(self):
+        loaded = []
+
+        def load_fun(samples_id):
+            loaded.append(samples_id)
+            return samples_id * 10
+
+        prefetcher = lib.labeler.SamplePrefetcher(load_fun, 10, 2, 1)
+        self.assertEqual(prefetcher.get(0), 0)
+        self.assertEqual(prefetcher.get(1), 10)
+        self.assertEqual(prefetcher.get(2), 20)
+        self.assertEqual(prefetcher.get(1), 10)
+        self.assertEqual((prefetcher.hits, prefetcher.misses), (3, 1))
+        self.assertLessEqual(len(prefetcher.cache), prefetcher.capacity)
+
+        # invalidate之后需要重新加载
+        prefetcher.invalidate(1)
+        self.assertEqual(prefetcher.get(1), 10)
+        self.assertEqual(prefetcher.misses, 2)
+        prefetcher.close()
+        self.assertEqual(loaded.count(1), 2)
+
+
+class TestDecodedImageCache(unittest.TestCase):
+
+    def test_cache(self):
+        root = tempfile.mkdtemp()
+        path = os.path.join(root, "image.png")
+        image = np.arange(60, dtype=np.uint8).reshape(4, 5, 3)
+        cv2.imwrite(path, image)
+        cache_dir = os.path.join(root, "cache")
+        cache = lib.util.DecodedImageCache(cache_dir)
+        self.assertIsNone(cache.get(path))
+        self.assertTrue(np.array_equal(cache.imread(path), image))
+        self.assertTrue(np.array_equal(cache.get(path), image))
+        # 源文件不存在时返回None
+        self.assertIsNone(cache.get(os.path.join(root, "missing.png")))
+        cache.close()
+
+        # index.json在close时保存
+        cache = lib.util.DecodedImageCache(cache_dir)
+        self.assertTrue(np.array_equal(cache.get(path), image))
+        cache.close()
+        shutil.rmtree(root)
+
+
+class TestAnnotationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_convert(self):
+        annotations = {"a": [[1, 2]], "b/c": [[3, 4, 5, 6]], "d": []}
+        src = lib.labeler.JsonFileStore(os.path.join(self.root, "ann"))
+        for name, anns in annotations.items():
+            src.save(name, anns)
+        self.assertEqual(src.names(), sorted(annotations.keys()))
+        self.assertIsNone(src.load("e"))
+
+        db_path = os.path.join(self.root, "ann.db")
+        writer = lib.labeler.SqliteStore(db_path)
+        self.assertEqual(lib.labeler.convert_annotations(src, writer), 3)
+
+        # save之后马上提交, 不需要close, 其他连接就可以读到
+        dst = lib.labeler.SqliteStore(db_path)
+        for name, anns in annotations.items():
+            self.assertEqual(dst.load(name), anns)
+        self.assertIsNone(dst.load("e"))
+        writer.close()
+
+        # 再转换回json格式
+        back = lib.labeler.JsonFileStore(os.path.join(self.root, "back"))
+        lib.labeler.convert_annotations(dst, back)
+        for name, anns in annotations.items():
+            self.assertEqual(back.load(name), anns)
+        dst.close()
+
+
+class TestAsyncJsonWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_writer(self):
+        writer = lib.util.AsyncJsonWriter()
+        path1 = os.path.join(self.root, "a", "1.json")
+        path2 = os.path.join(self.root, "2.json")
+        # 拿着锁的时候后台线程不能写入, 写入的数据都留在队列中
+        with writer.cond:
+            data = {"value": 1}
+            writer.write(data, path1)
+            data["value"] = 2
+            writer.write(data, path1)
+            writer.write([1, 2], path2)
+            data["value"] = 3
+            # 同一个文件的多次写入被合并, 队列中的数据是write时的拷贝
+            self.assertEqual(list(writer.pending), [path1, path2])
+            self.assertEqual(writer.read(path1), {"value": 2})
+            self.assertFalse(os.path.exists(path1))
+            # JsonFileStore通过writer读取还没有写入磁盘的标注
+            store = lib.labeler.JsonFileStore(self.root, writer)
+            store.save("3", [[1, 2, 3, 4]])
+            self.assertEqual(store.load("3"), [[1, 2, 3, 4]])
+        writer.flush()
+        self.assertFalse(writer.pending)
+        self.assertEqual(lib.util.read_json_file(path1), {"value": 2})
+        self.assertEqual(writer.read(path2), [1, 2])
+        self.assertIsNone(writer.read(os.path.join(self.root, "4.json")))
+
+        # close之前写入的数据都会写入磁盘, 之后不能再写入
+        with writer.cond:
+            writer.write({"value": 4}, path1)
+        writer.close()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(lib.util.read_json_file(path1), {"value": 4})
+        with self.assertRaises(AssertionError):
+            writer.write({}, path1)
+
+    def test_atomic_write(self):
+        path = os.path.join(self.root, "a", "data.json")
+        lib.util.write_json_file({"value": 1}, path, atomic=True)
+        self.assertEqual(lib.util.read_json_file(path), {"value": 1})
+        lib.util.write_json_file({"value": 2}, path, atomic=True)
+        self.assertEqual(lib.util.read_json_file(path), {"value": 2})
+        # 写入失败时原来的文件不变, 也不会留下临时文件
+        with self.assertRaises(TypeError):
+            lib.util.write_json_file({"value": object()}, path, atomic=True)
+        self.assertEqual(lib.util.read_json_file(path), {"value": 2})
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["data.json"])
+
+
+class TestSampleList(unittest.TestCase):
+
+    def test_sample_list(self):
+        root = tempfile.mkdtemp()
+        path = os.path.join(root, "samples.txt")
+        for content in ["", "a\n", "a", " a \r\nb\n\nc", "\n\n"]:
+            with open(path, "w", encoding="utf-8") as dstfile:
+                dstfile.write(content)
+            expected = lib.util.read_list_file(path)
+            # 第一次建立索引, 第二次从缓存中读取索引
+            for cache in [False, True, True]:
+                samples = lib.util.SampleList(path, cache)
+                self.assertEqual(len(samples), len(expected))
+                self.assertEqual(list(samples), expected)
+            if expected:
+                self.assertEqual(samples[-1], expected[-1])
+        shutil.rmtree(root)
+
+
+class TestFrameProfiler(unittest.TestCase):
+
+    def test_profiler(self):
+        root = tempfile.mkdtemp()
+        trace_file = os.path.join(root, "trace.jsonl")
+        profiler = lib.labeler.FrameProfiler(trace_file, window=3)
+        for n in range(5):
+            profiler.begin_frame()
+            with profiler.span("wait_key"):
+                pass
+            # 只有wait_key的帧不纪录
+            if n % 2 == 0:
+                with profiler.span("draw"):
+                    with profiler.span("text"):
+                        time.sleep(0.001)
+                with profiler.span("draw"):
+                    pass
+            profiler.end_frame(samples_id=n)
+        profiler.close()
+        self.assertEqual(profiler.num_frames, 3)
+        p50, p95 = profiler.percentiles("draw")
+        self.assertGreaterEqual(p95, p50)
+        self.assertGreaterEqual(p50, profiler.percentiles("text")[0])
+        self.assertIsNone(profiler.percentiles("load"))
+        self.assertEqual(len(profiler.summary_lines(["draw", "load"])), 1)
+
+        with open(trace_file, encoding="utf-8") as srcfile:
+            records = [json.loads(line) for line in srcfile]
+        self.assertEqual([r["samples_id"] for r in records], [0, 2, 4])
+        self.assertEqual(set(records[0]["spans"]), {"wait_key", "draw", "text"})
+        shutil.rmtree(root)
+
+
+class TestScaleLabeler(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "images"))
+        for name in ["a", "b"]:
+            image = np.full((300, 400, 3), 128, dtype=np.uint8)
+            cv2.imwrite(os.path.join(self.root, "images", name + ".jpg"), image)
+        lib.util.write_list_file(["a", "b"],
+                                 os.path.join(self.root, "samples.txt"))
+        self.params = {
+            "img_dir": os.path.join(self.root, "images"),
+            "ann_dir": os.path.join(self.root, "annotations"),
+            "snapshot": os.path.join(self.root, "snapshot.json"),
+            "samples": os.path.join(self.root, "samples.txt")
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_layers(self):
+        labeler = RegionLabeler(self.params, scale=0.5)
+        # 画文字需要字体文件, 与这里的测试无关
+        labeler._draw_text_lines = lambda image: image
+        labeler._load_curr_sample()
+        static_layers = []
+        draw_static_layer = labeler._draw_static_layer
+
+        def counted(image):
+            static_layers.append(image)
+            return draw_static_layer(image)
+
+        labeler._draw_static_layer = counted
+        labeler._mouse_callback(cv2.EVENT_LBUTTONDOWN, 10, 10, 0)
+        labeler._mouse_callback(cv2.EVENT_LBUTTONDOWN, 100, 80, 0)
+        self.assertEqual(len(labeler.curr_annotations), 1)
+        show = labeler._draw_curr_image()
+        self.assertEqual(show.shape, (150, 200, 3))
+        self.assertEqual(len(static_layers), 1)
+
+        # 光标移动和选中只重画动态层, 并且不会改动缓存的层
+        base = labeler.base_layer.copy()
+        static = labeler.static_layer.copy()
+        for x, y in [(150, 120), (50, 50), (60, 40)]:
+            labeler._mouse_callback(cv2.EVENT_MOUSEMOVE, x, y, 0)
+            labeler._draw_curr_image()
+        self.assertEqual(len(static_layers), 1)
+        self.assertTrue(np.array_equal(labeler.base_layer, base))
+        self.assertTrue(np.array_equal(labeler.static_layer, static))
+
+        # 修改标注和缩放之后需要重画静态标注层
+        self.assertIsNotNone(labeler.selected_region)
+        labeler._delete_selected_region()
+        labeler._draw_curr_image()
+        self.assertEqual(len(static_layers), 2)
+        labeler._mouse_callback(cv2.EVENT_MOUSEWHEEL, 0, 0, -1)
+        show = labeler._draw_curr_image()
+        self.assertEqual(len(static_layers), 3)
+        self.assertIsNot(labeler.base_layer, base)
+        self.assertGreater(show.shape[1], 200)
+        labeler.ann_store.close()
+
+    def test_map_points(self):
+        labeler = RegionLabeler(self.params, scale=0.37)
+        labeler._load_curr_sample()
+        labeler.curr_roi = lib.labeler.BoundingBox(150, 40, 21, 230)
+        points = np.random.RandomState(0).randint(-50, 450, (100, 2))
+        mapped = labeler._map_points_to(points)
+        self.assertEqual(mapped.tolist(),
+                         [list(labeler._map_to(p)) for p in points.tolist()])
+        back = labeler._map_points_back(mapped)
+        self.assertEqual(back.tolist(),
+                         [list(labeler._map_back(p)) for p in mapped.tolist()])
+
+        # 批量画的矩形与逐个画的一致, 坐标为负的矩形被跳过
+        boxes = np.concatenate([points[:50], points[50:]], axis=1)
+        batch = np.zeros((200, 200, 3), dtype=np.uint8)
+        single = batch.copy()
+        for thickness in [1, 2]:
+            labeler._draw_bounding_boxes(batch, boxes, (0, 0, 255), thickness)
+            for box in boxes.tolist():
+                bbox = lib.labeler.BoundingBox(*box)
+                labeler._draw_bounding_box(single, bbox, (0, 0, 255), thickness)
+            self.assertTrue(np.array_equal(batch, single))
+        labeler.ann_store.close()
+
+    def test_save(self):
+        params = dict(self.params, snapshot_interval=60, snapshot_moves=3)
+        labeler = RegionLabeler(params)
+        labeler._load_curr_sample()
+        path_a = os.path.join(self.root, "annotations", "a.json")
+        path_b = os.path.join(self.root, "annotations", "b.json")
+
+        # 没有修改过的标注不保存, 修改之后离开时保存
+        labeler._move(1)
+        self.assertFalse(os.path.exists(path_a))
+        labeler._mouse_callback(cv2.EVENT_LBUTTONDOWN, 10, 10, 0)
+        labeler._mouse_callback(cv2.EVENT_LBUTTONDOWN, 100, 80, 0)
+        self.assertEqual(labeler.curr_revision, 1)
+        labeler._move(-1)
+        self.assertEqual(len(lib.util.read_json_file(path_b)), 1)
+        labeler._move(1)
+        os.remove(path_b)
+        labeler._save_curr_sample()
+        self.assertFalse(os.path.exists(path_b))
+        # 's'和ESC强制保存
+        labeler._save_curr_sample(force=True)
+        self.assertEqual(len(lib.util.read_json_file(path_b)), 1)
+        os.remove(path_b)
+        labeler._move(-1)
+        self.assertFalse(os.path.exists(path_b))
+
+        # 进度至少间隔snapshot_moves次移动或者snapshot_interval秒才保存
+        snapshot = self.params["snapshot"]
+        if os.path.exists(snapshot): os.remove(snapshot)
+        labeler.samples_id, labeler.num_moves = 0, 2
+        labeler._save_snapshot()
+        self.assertFalse(os.path.exists(snapshot))
+        labeler.num_moves = 3
+        labeler._save_snapshot()
+        self.assertEqual(lib.util.read_json_file(snapshot), {"samples_id": 0})
+        labeler.samples_id, labeler.num_moves = 1, 0
+        labeler._save_snapshot()
+        self.assertEqual(lib.util.read_json_file(snapshot), {"samples_id": 0})
+        labeler.snapshot_time -= 60
+        labeler._save_snapshot()
+        self.assertEqual(lib.util.read_json_file(snapshot), {"samples_id": 1})
+        # 进度没有变化时不保存, 除非强制保存
+        os.remove(snapshot)
+        labeler.snapshot_time -= 60
+        labeler._save_snapshot()
+        self.assertFalse(os.path.exists(snapshot))
+        labeler._save_snapshot(force=True)
+        self.assertEqual(lib.util.read_json_file(snapshot), {"samples_id": 1})
+        labeler._close()
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def test_grid_index(self):
+        index = lib.labeler.GridIndex(cell_size=16)
+        points = [(3, 4), (40, 40), (100, 7), (40, 40)]
+        for point in points:
+            index.add(point, (*point, *point))
+        self.assertEqual(index.nearest(38, 41), ((40, 40), 5))
+        self.assertEqual(index.nearest(200, 200, max_dist=10), (None, None))
+        self.assertEqual(index.nearest(200, 0)[0], (100, 7))
+
+        # 重复添加的点需要删除两次
+        index.remove((40, 40))
+        self.assertEqual(index.nearest(38, 41)[0], (40, 40))
+        index.remove((40, 40))
+        self.assertEqual(index.nearest(38, 41)[0], (3, 4))
+
+        bbox1 = lib.labeler.BoundingBox(0, 0, 50, 50)
+        bbox2 = lib.labeler.BoundingBox(45, 45, 20, 20)
+        index.clear()
+        index.add(bbox1, bbox1.bbox)
+        index.add(bbox2, bbox2.bbox)
+        self.assertEqual(set(index.query_point(30, 45)), {bbox1, bbox2})
+        self.assertEqual(index.query_point(50, 0), [bbox1])
+        self.assertEqual(index.query_point(51, 0), [])
+        index.remove(bbox1)
+        self.assertEqual(index.query_point(30, 45), [bbox2])
+
+    def test_float_coords(self):
+        index = lib.labeler.GridIndex(cell_size=16)
+        index.add("box", (1.5, 2.5, 30.5, 40.5))
+        index.add("point", (-3.5, 60.25, -3.5, 60.25))
+        self.assertEqual(index.query_point(20.5, 35.0), ["box"])
+        self.assertEqual(index.query_point(31.0, 35.0), [])
+        self.assertEqual(index.nearest(16.0, 21.5), ("box", 0.0))
+        self.assertEqual(index.nearest(-2.5, 60.25), ("point", 1.0))
+        index.remove("box")
+        self.assertEqual(index.query_point(20.5, 35.0), [])
+
+
+def _square(x, offset):
+    return x * x + offset
+
+
+def _unreliable(x):
+    if x == 3: os._exit(1)  # 模拟进程崩溃
+    if x == 5: raise ValueError(x)
+    if x == 7: time.sleep(60)
+    return x
+
+
+def _sleep(x):
+    time.sleep(0.2)
+    return x
+
+
+def _slow_head(x):
+    if x == 0: time.sleep(1)
+    return x
+
+
+class _BrokenTask:
+
+    def __init__(self):
+        raise ValueError("broken")
+
+    def process(self, x):
+        return x
+
+
+async def _square_async(x, offset):
+    await asyncio.sleep(0.001)
+    return x * x + offset
+
+
+def _make_array(x):
+    return np.full((256, 256), x, np.int32), {"x": x}
+
+
+def _make_array_or_exit(x):
+    if x == 1: os._exit(1)  # 模拟进程崩溃
+    return _make_array(x)
+
+
+class TestTaskPool(unittest.TestCase):
+
+    def test_imap(self):
+        pool = lib.util.TaskPool.get_pool(3, _square, 1)
+        expected = [x * x + 1 for x in range(100)]
+        progress = []
+        results = pool.imap((x for x in range(100)),
+                            batch_size=8,
+                            progress=lambda *args: progress.append(args))
+        self.assertEqual(list(results), expected)
+        self.assertEqual(progress[-1], (100, None))
+        results = pool.imap_unordered(range(100), batch_size=8)
+        self.assertEqual(sorted(results), expected)
+
+        # 提前退出之后pool还可以继续使用
+        for result in pool.imap(range(1000), batch_size=16):
+            if result > 10: break
+        self.assertEqual(pool.process([2, 3]), [5, 10])
+        stats = pool.stats()
+        self.assertEqual(len(stats), 3)
+        self.assertGreaterEqual(sum(stat["items"] for stat in stats), 202)
+
+        # 打包传递, chunksize为0时自动调整
+        for chunksize in [7, 0]:
+            results = pool.imap(range(100), chunksize=chunksize)
+            self.assertEqual(list(results), expected)
+        results = pool.imap_unordered(range(100), batch_size=5, chunksize=0)
+        self.assertEqual(sorted(results), expected)
+        pool.finish()
+        self.assertEqual(
+            lib.util.TaskPool.map(1, _square, range(3), 2), [2, 3, 6])
+
+    def test_reorder_limit(self):
+        pool = lib.util.TaskPool.get_pool(3, _slow_head, backend="thread")
+        consumed = []
+
+        def samples():
+            for x in range(1000):
+                consumed.append(x)
+                yield x
+
+        # 第一个样本很慢时, 等待重排序的结果也计入batch_size, 不会读入
+        # 所有的样本
+        results = pool.imap(samples(), batch_size=16)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(consumed), 16)
+        self.assertEqual(list(results), list(range(1, 1000)))
+        pool.finish()
+
+    def test_shared_memory(self):
+        transport = lib.util.SharedArrayTransport(1 << 20, 2)
+        pool = lib.util.TaskPool.get_pool(2, _make_array, transport=transport)
+        # 块用完之后退回到pickle, 结果仍然正确
+        results = pool.process(range(6))
+        infos = [info for _, info in results]
+        self.assertEqual(infos, [{"x": x} for x in range(6)])
+        self.assertTrue(
+            all((array == x).all() for x, (array, _) in enumerate(results)))
+        self.assertEqual(len(transport.in_use), 2)
+        del results
+        self.assertEqual(len(transport.in_use), 0)
+        for x, (array, _) in enumerate(pool.imap(range(6))):
+            self.assertTrue((array == x).all())
+        pool.finish()
+
+        # 提前退出时丢弃的结果也要放回它们的块
+        transport = lib.util.SharedArrayTransport(1 << 20, 4)
+        pool = lib.util.TaskPool.get_pool(2, _make_array, transport=transport)
+        for _ in range(3):
+            for array, _ in pool.imap(range(20), batch_size=8):
+                break
+        del array
+        self.assertEqual(len(transport.in_use), 0)
+        names = {transport.free_queue.get(timeout=1) for _ in range(4)}
+        self.assertEqual(len(names), 4)
+        pool.finish()
+
+        # worker取走块之后, 返回结果之前退出, 块会被放回空闲队列
+        transport = lib.util.SharedArrayTransport(1 << 20, 2)
+        pool = lib.util.TaskPool.get_pool(
+            2,
+            _make_array_or_exit,
+            transport=transport,
+            max_retries=0,
+            return_failures=True)
+        results = pool.process(range(2), chunksize=2)
+        self.assertIsInstance(results[1], lib.util.TaskFailure)
+        del results
+        pool.finish()
+        names = {transport.free_queue.get(timeout=1) for _ in range(2)}
+        self.assertEqual(len(names), 2)
+
+    def test_failures(self):
+        for chunksize in [1, 4]:
+            results = lib.util.TaskPool.map(
+                3,
+                _unreliable,
+                range(10),
+                chunksize=chunksize,
+                timeout=0.5,
+                return_failures=True)
+            for x, result in enumerate(results):
+                if x in (3, 5, 7):
+                    self.assertIsInstance(result, lib.util.TaskFailure)
+                else:
+                    self.assertEqual(result, x)
+            self.assertIsInstance(results[5].error, ValueError)
+        # 默认在调用者中抛出process的异常
+        for num_threads in [1, 3]:
+            with self.assertRaises(ValueError):
+                lib.util.TaskPool.map(num_threads, _unreliable, [1, 5, 2])
+
+    def test_lost_sample(self):
+        pool = lib.util.TaskPool.get_pool(3, _square, 1, timeout=2)
+        while not all(pool.status.ready):
+            time.sleep(0.01)
+        # 被杀掉的worker正在等待输入, 不能影响其他worker的输入队列
+        time.sleep(0.1)
+        os.kill(pool.processes[0].pid, signal.SIGKILL)
+        pool.processes[0].join()
+        results = pool.process(range(30))
+        self.assertEqual(results, [x * x + 1 for x in range(30)])
+        # 已经分配给退出的worker的样本重新分配给其他的worker
+        os.kill(pool.processes[1].pid, signal.SIGKILL)
+        pool.processes[1].join()
+        for sid in range(6):
+            pool._submit(sid, sid)
+        self.assertGreater(pool.assigned[1], 0)
+        results = []
+        while pool.pending:
+            results += pool._receive()
+        self.assertEqual(sorted(results), [(x, x * x + 1) for x in range(6)])
+        pool.finish()
+
+    def test_init_failure(self):
+        for backend in ["process", "thread"]:
+            pool = lib.util.TaskPool(_BrokenTask, [()] * 2, backend=backend)
+            with self.assertRaises(RuntimeError):
+                pool.process(range(3))
+
+    def test_backends(self):
+        expected = [x * x + 1 for x in range(50)]
+        for backend in ["thread", "asyncio"]:
+            results = lib.util.TaskPool.map(
+                4, _square, range(50), 1, backend=backend)
+            self.assertEqual(results, expected)
+        results = lib.util.TaskPool.map(
+            4, _square_async, range(50), 1, chunksize=3, backend="asyncio")
+        self.assertEqual(results, expected)
+        # 普通函数在线程池中执行, 不会阻塞其他的协程
+        start = time.time()
+        results = lib.util.TaskPool.map(4, _sleep, range(4), backend="asyncio")
+        self.assertEqual(results, list(range(4)))
+        self.assertLess(time.time() - start, 0.6)
+
+    def test_checkpoint(self):
+        root = tempfile.mkdtemp()
+        path = os.path.join(root, "checkpoint.bin")
+        expected = [x * x + 1 for x in range(100)]
+        pool = lib.util.TaskPool.get_pool(3, _square, 1)
+        for result in pool.imap(range(100), chunksize=3, checkpoint=path):
+            if result > 1000: break
+        # 模拟写到一半时被中断
+        with open(path, "ab") as dstfile:
+            dstfile.write(b"\x00" * 5)
+        with lib.util.Checkpoint(path) as checkpoint:
+            num_saved = len(checkpoint)
+            self.assertGreater(num_saved, 30)
+            num_items = sum(stat["items"] for stat in pool.stats())
+            results = pool.process(range(100), checkpoint=checkpoint)
+            self.assertEqual(results, expected)
+            # 同一个Checkpoint再次使用时, 本次运行中完成的样本也不再处理
+            self.assertEqual(
+                pool.process(range(100), checkpoint=checkpoint), expected)
+        with lib.util.Checkpoint(path) as checkpoint:
+            self.assertEqual(len(checkpoint), 100)
+        # 只处理了没有完成的样本
+        num_items = sum(stat["items"] for stat in pool.stats()) - num_items
+        self.assertEqual(num_items, len(expected) - num_saved)
+        pool.finish()
+        shutil.rmtree(root)
+
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -21,32 +21,56 @@ class PointLabeler(lib.labeler.ScaleLabeler):
         super().__init__(params, scale)
         self.cache_point = None
         self.selected_point = None
+        self.point_index = lib.labeler.GridIndex()
 
     def _load_annotations(self, samples_id):
-        return super()._load_annotations(samples_id) or []
+        annotations = super()._load_annotations(samples_id) or []
+        return lib.labeler.PointSet(annotations)
 
     def _load_curr_sample(self):
         super()._load_curr_sample()
         self.cache_point = None
         self.selected_point = None
+        self.point_index.clear()
+        for point in self.curr_annotations:
+            self.point_index.add(point, (*point, *point))
 
-    def _draw_curr_image(self):
-        show = super()._draw_curr_image()
-        for x, y in self.curr_annotations:
-            x, y = self._map_to(point=(x, y))
-            cv2.circle(show, (x, y), 4, (0, 255, 255), thickness=-1)
+    def _save_annotations(self, annotations, samples_id):
+        if not annotations: return
+        annotations = annotations.to_list()
+        super()._save_annotations(annotations, samples_id)
+
+    def _draw_static_layer(self, image):
+        # 所有的标注点只在标注被修改或者缩放之后才重新绘制
+        image = super()._draw_static_layer(image)
+        points = self._map_points_to(self.curr_annotations.points)
+        for x, y in points.tolist():
+            cv2.circle(image, (x, y), 4, (0, 255, 255), thickness=-1)
+        return image
+
+    def _draw_dynamic_layer(self, image):
+        image = super()._draw_dynamic_layer(image)
         if self.selected_point:
             x, y = self._map_to(self.selected_point)
-            cv2.circle(show, (x, y), 8, (0, 0, 255), thickness=-1)
-        return show
+            cv2.circle(image, (x, y), 8, (0, 0, 255), thickness=-1)
+        return image
 
     def _get_closest_point(self, x, y):
-        distances = []
-        for x1, y1 in self.curr_annotations:
-            dist = (x1 - x) ** 2 + (y1 - y) ** 2
-            distances.append(((x1, y1), dist))
-        if not distances: return None, None
-        return min(distances, key=lambda v: v[-1])
+        # 只查找40像素以内的点, 更远的点对选择和添加都没有影响
+        return self.point_index.nearest(x, y, max_dist=40)
+
+    def _add_point(self, x, y):
+        self.curr_annotations.append((x, y))
+        self.point_index.add((x, y), (x, y, x, y))
+        self._modify()
+
+    def _delete_selected_point(self):
+        if self.selected_point:
+            self.curr_annotations.remove(self.selected_point)
+            self.point_index.remove(self.selected_point)
+            self.selected_point = None
+            self.cache_point = None
+            self._modify()
 
     def _mouse_callback(self, event, x, y, flags):
         super()._mouse_callback(event, x, y, flags)
@@ -63,31 +87,30 @@ class PointLabeler(lib.labeler.ScaleLabeler):
                     (self.cache_point.y1 == y)):
                 point, dist = self._get_closest_point(x, y)
                 if point is None or dist > 1600:
-                    self.curr_annotations.append((x, y))
+                    self._add_point(x, y)
             self.cache_point = None
         # 鼠标拖动, 选择一个标注点
         elif event == cv2.EVENT_MOUSEMOVE:
             self.cache_point = None
+            selected_point = self.selected_point
             self.selected_point = None
             point, dist = self._get_closest_point(x, y)
             if point is not None and dist < 1600:
                 self.selected_point = point
+            if self.selected_point != selected_point:
+                self._invalidate()
         # 鼠标右键按下, 删除选中的标注点
         elif event == cv2.EVENT_RBUTTONDOWN:
-            if self.selected_point:
-                self.curr_annotations.remove(self.selected_point)
-                self.selected_point = None
-                self.cache_point = None
+            self._delete_selected_point()
 
     def _key_callback(self, key):
         super()._key_callback(key)
         if key == ord("d"):
-            if self.selected_point:
-                self.curr_annotations.remove(self.selected_point)
-                self.selected_point = None
-                self.cache_point = None
+            self._delete_selected_point()
         elif key == ord("c"):
-            self.curr_annotations = []
+            self.curr_annotations = lib.labeler.PointSet()
+            self.point_index.clear()
+            self._modify()
 
 
 if __name__ == "__main__":
@@ -24,47 +24,58 @@ class RegionLabeler(lib.labeler.ScaleLabeler):
         self.selected_region = None
         self.cache_region = None
         self.cursor = None
+        self.region_index = lib.labeler.GridIndex(cell_size=128)
 
     def _load_annotations(self, samples_id):
         annotations = super()._load_annotations(samples_id) or []
-        return [lib.labeler.BoundingBox(*ann) for ann in annotations]
+        return lib.labeler.BoxSet(annotations)
 
     def _load_curr_sample(self):
         super()._load_curr_sample()
         self.selected_region = None
         self.cache_region = None
         self.cursor = None
+        self.region_index.clear()
+        for bbox in self.curr_annotations:
+            self.region_index.add(bbox, bbox.bbox)
 
     def _save_annotations(self, annotations, samples_id):
         if not annotations: return
-        annotations = [ann.bbox for ann in annotations]
+        annotations = annotations.to_list()
         super()._save_annotations(annotations, samples_id)
 
-    def _draw_curr_image(self):
-        show = super()._draw_curr_image()
+    def _draw_static_layer(self, image):
         # draw rectangles (bbox相对于原始图像)
-        for bbox in self.curr_annotations:
-            thickness = 2 if bbox is self.selected_region else 1
-            self._draw_bounding_box(show, bbox, (0, 0, 255), thickness)
+        image = super()._draw_static_layer(image)
+        boxes = self.curr_annotations.boxes
+        self._draw_bounding_boxes(image, boxes, (0, 0, 255), 1)
+        return image
+
+    def _draw_dynamic_layer(self, image):
+        image = super()._draw_dynamic_layer(image)
+        # 选中的区域在静态标注层之上加粗重画
+        if self.selected_region:
+            self._draw_bounding_box(image, self.selected_region, (0, 0, 255), 2)
         if self.cache_region and self.cache_region.valid():
-            self._draw_bounding_box(show, self.cache_region, (0, 0, 255), 1)
+            self._draw_bounding_box(image, self.cache_region, (0, 0, 255), 1)
         # cursor相对于显示窗口
         if (not self.cache_region) and self.cursor:
             x, y = self.cursor
-            height, width = show.shape[:2]
-            cv2.line(show, (x, y), (width, y), (0, 0, 255), 1)
-            cv2.line(show, (x, y), (x, height), (0, 0, 255), 1)
-        return show
+            height, width = image.shape[:2]
+            cv2.line(image, (x, y), (width, y), (0, 0, 255), 1)
+            cv2.line(image, (x, y), (x, height), (0, 0, 255), 1)
+        return image
 
     def _select_region(self, x, y):
-        def check_fun(bbox): return bbox.contains(point=(x, y))
-        selected = list(filter(check_fun, self.curr_annotations))
+        selected = self.region_index.query_point(x, y)
         if not selected: return None
         return max(selected, key=lambda bbox: bbox.area)
 
     def _delete_selected_region(self):
         if self.selected_region:
             self.curr_annotations.remove(self.selected_region)
+            self.region_index.remove(self.selected_region)
+            self._modify()
         self.selected_region = None
         self.cache_region = None
         self.cursor = None
@@ -73,6 +84,7 @@ class RegionLabeler(lib.labeler.ScaleLabeler):
         super()._mouse_callback(event, x, y, flags)
         ox, oy = self._map_back(point=(x, y))
         if event == cv2.EVENT_LBUTTONDOWN:
+            self._invalidate()
             if self.cache_region is None:
                 self.cache_region = lib.labeler.BoundingBox()
                 self.cache_region.x1 = ox
@@ -81,9 +93,13 @@ class RegionLabeler(lib.labeler.ScaleLabeler):
                 self.cache_region.x2 = ox
                 self.cache_region.y2 = oy
                 if self.cache_region.area > 400:
-                    self.curr_annotations.append(self.cache_region)
+                    bbox = self.curr_annotations.append(self.cache_region)
+                    self.region_index.add(bbox, bbox.bbox)
+                    self._modify()
                 self.cache_region = None
         elif event == cv2.EVENT_MOUSEMOVE:
+            # 光标随鼠标移动, 所以每次都需要重新绘制
+            self._invalidate()
             self.cursor = None
             if flags == cv2.EVENT_FLAG_LBUTTON:
                 self.cache_region = None
@@ -95,13 +111,17 @@ class RegionLabeler(lib.labeler.ScaleLabeler):
                 self.cursor = (x, y)
         elif event == cv2.EVENT_RBUTTONDOWN:
             self._delete_selected_region()
+            self._invalidate()
 
     def _key_callback(self, key):
         super()._key_callback(key)
         if key == ord("d"):  # 按d删除选中的区域
             self._delete_selected_region()
         elif key == ord("c"):
-            self.curr_annotations = []
+            self.curr_annotations = lib.labeler.BoxSet()
+            self.region_index.clear()
+            self.selected_region = None
+            self._modify()
 
 
 if __name__ == "__main__":